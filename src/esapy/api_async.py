@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import api_esa, api_growi
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class AsyncClient(object):
+    '''asyncio interface of esa.io / growi API
+
+    Each operation runs the blocking call of `api_esa` / `api_growi` on a worker
+    thread, so the event loop is never blocked. At most `max_concurrency` calls
+    are in flight, and all of them share the pooled session of the destination.
+
+    ```python
+    async with AsyncClient('esa', token=token, team=team) as client:
+        urls = await client.upload_many(filenames)
+    ```
+    '''
+
+    def __init__(self, dest, token=None, team=None, url=None, proxy=None, max_concurrency=8):
+        if dest == 'esa':
+            self._api = api_esa
+            self._kwargs = dict(token=token, team=team, proxy=proxy)
+        elif dest == 'growi':
+            self._api = api_growi
+            self._kwargs = dict(token=token, url=url, proxy=proxy)
+        else:
+            raise RuntimeError('invalid dest.')
+        self.dest = dest
+        self.max_concurrency = max_concurrency
+
+        self._api.get_client(**self._kwargs).ensure_pool_size(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def close(self):
+        '''wait for calls in flight, which cannot be cancelled once started on a worker thread
+        '''
+        self._executor.shutdown(wait=True)
+
+    async def aclose(self):
+        '''`close` without blocking the event loop
+        '''
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        f = functools.partial(func, *args, **dict(self._kwargs, **kwargs))
+        return await loop.run_in_executor(self._executor, f)
+
+    async def get_team_stats(self):
+        return await self._call(self._api.get_team_stats)
+
+    async def upload_binary(self, filename):
+        '''Return: (url, response)
+        '''
+        return await self._call(self._api.upload_binary, filename)
+
+    async def upload_many(self, filenames, return_exceptions=False):
+        '''upload files concurrently and return their urls in the same order
+        '''
+        res = await asyncio.gather(*[self.upload_binary(fn) for fn in filenames],
+                                   return_exceptions=return_exceptions)
+        return [r if isinstance(r, BaseException) else r[0] for r in res]
+
+    async def get_post(self, post_number):
+        return await self._call(self._api.get_post, post_number)
+
+    async def get_post_by_path(self, pagepath):
+        '''growi only
+        '''
+        if self.dest != 'growi':
+            raise RuntimeError('get_post_by_path is supported only for growi.')
+        return await self._call(self._api.get_post_by_path, pagepath)
+
+    async def create_post(self, body_md, **kwargs):
+        '''Return: (url, response)
+        '''
+        return await self._call(self._api.create_post, body_md, **kwargs)
+
+    async def patch_post(self, post_number, body_md, **kwargs):
+        '''Return: (url, response)
+        '''
+        return await self._call(self._api.patch_post, post_number, body_md, **kwargs)
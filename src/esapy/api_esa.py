@@ -1,38 +1,52 @@
 #!/usr/bin/env python3
 
-import os
 from pathlib import Path
+import io
 import mimetypes
-import requests
 import json
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+from .httpclient import HttpClient, ClientRegistry
+from .multipart import log_progress
 
 # logger
 from logging import getLogger
 logger = getLogger(__name__)
 
 
-def _set_proxy(proxy):
-    if proxy is None:
-        logger.debug('No proxy is addressed.')
-        return
+class PostNotFound(RuntimeError):
+    '''the post has been removed (404)'''
+    pass
+
+
+class EsaClient(HttpClient):
+    '''pooled session for esa.io API of a team
+    '''
+
+    def __init__(self, token, team, proxy=None):
+        super().__init__(headers=dict(Authorization='Bearer %s' % token), proxy=proxy)
+        self.team = team
+
+
+_registry = ClientRegistry(EsaClient)
+
 
-    logger.info('Addressed proxy: %s' % proxy)
-    os.environ['HTTP_PROXY'] = proxy
-    logger.debug('HTTP_PROXY={:s}'.format(os.environ['HTTP_PROXY']))
-    os.environ['HTTPS_PROXY'] = proxy
-    logger.debug('HTTPS_PROXY={:s}'.format(os.environ['HTTPS_PROXY']))
+def get_client(token=None, team=None, proxy=None):
+    '''return the client shared by all calls for (token, team, proxy)
+    '''
+    return _registry.get(token, team, proxy)
 
 
 def get_team_stats(token=None, team=None, proxy=None):
     logger.info('Getting team statistics')
 
-    _set_proxy(proxy)
+    client = get_client(token, team, proxy)
 
     # get metadata
     url = 'https://api.esa.io/v1/teams/%s/stats' % team
-    header = dict(Authorization='Bearer %s' % token)
 
-    res = requests.get(url, headers=header)
+    res = client.get(url)
     if res.status_code != 200:
         logger.warning('Getting team statistics failed.')
         raise RuntimeError('Getting team statistics failed.')
@@ -43,23 +57,29 @@ def get_team_stats(token=None, team=None, proxy=None):
     return d
 
 
-def upload_binary(filename, token=None, team=None, proxy=None):
+def upload_binary(filename, token=None, team=None, proxy=None, progress=None, data=None):
+    '''upload a file as an attachment
+
+    The file is streamed to the storage in chunks.
+    If `data` (bytes) is given, it is uploaded from memory and `filename` is used only as its name.
+    `progress(bytes_sent, total)` is called during sending, default is logging.
+    '''
     path_bin = Path(filename)
+    size = len(data) if data is not None else path_bin.stat().st_size
     logger.info('Uploading binary data, path=%s' % str(path_bin))
-    logger.info('  filesize: %d' % path_bin.stat().st_size)
+    logger.info('  filesize: %d' % size)
 
-    _set_proxy(proxy)
+    client = get_client(token, team, proxy)
 
     # get metadata
     logger.info('Obtaining metadata for upload...')
     url = 'https://api.esa.io/v1/teams/%s/attachments/policies' % team
-    header = dict(Authorization='Bearer %s' % token)
     mtype = mimetypes.guess_type(str(path_bin))[0]
     mtype = mtype if mtype is not None else 'application/octet-stream'
     params = dict(type=mtype,
                   name=path_bin.name,
-                  size=path_bin.stat().st_size)
-    res = requests.post(url, headers=header, params=params)
+                  size=size)
+    res = client.post(url, params=params)
 
     if res.status_code != 200:
         logger.warning('Obtaining metadata failed, %s' % str(path_bin))
@@ -74,10 +94,13 @@ def upload_binary(filename, token=None, team=None, proxy=None):
     # upload file
     logger.info('Posting binary...')
     url = metadata['attachment']['endpoint']
-    with path_bin.open('rb') as imgfile:
-        params = metadata['form']
-        params['file'] = imgfile
-        res = requests.post(url, files=params)
+    progress = progress if progress is not None else log_progress(path_bin.name)
+    with (io.BytesIO(data) if data is not None else path_bin.open('rb')) as imgfile:
+        fields = list(metadata['form'].items())
+        # the form is signed by itself, so the esa.io token must not be sent to the storage
+        res = client.post_multipart(url, fields, ('file', path_bin.name, imgfile, mtype),
+                                    callback=progress,
+                                    headers=dict(Authorization=None))
 
     if not (200 <= res.status_code < 300):
         logger.warning('Upload failed, %s' % str(path_bin))
@@ -87,16 +110,24 @@ def upload_binary(filename, token=None, team=None, proxy=None):
     return image_url, res
 
 
+def is_alive(url, token=None, team=None, proxy=None):
+    '''check an attachment url, see `HttpClient.is_alive`
+    '''
+    # attachments are served by another host, which must not receive the esa.io token
+    return get_client(token, team, proxy).is_alive(url, headers=dict(Authorization=None))
+
+
 def get_post(post_number, token=None, team=None, proxy=None):
     logger.info('Getting post/{:d}'.format(post_number))
 
-    _set_proxy(proxy)
+    client = get_client(token, team, proxy)
 
     # get metadata
     url = 'https://api.esa.io/v1/teams/{:s}/posts/{:d}'.format(team, post_number)
-    header = dict(Authorization='Bearer {:s}'.format(token))
 
-    res = requests.get(url, headers=header)
+    res = client.get(url)
+    if res.status_code == 404:
+        raise PostNotFound('post/{:d} is not found.'.format(post_number))
     if res.status_code != 200:
         logger.warning('Getting post failed.')
         raise RuntimeError('Getting post failed.')
@@ -108,14 +139,58 @@ def get_post(post_number, token=None, team=None, proxy=None):
     return d
 
 
+def get_post_info(post_number, token=None, team=None, proxy=None, etag=None, updated_at=None):
+    '''get attributes of a post with a conditional request
+
+    `etag` and/or `updated_at` (ISO 8601) cached from the previous lookup are sent as
+    `If-None-Match` / `If-Modified-Since`. Only a 304 response saves the transfer; on 200
+    the whole post including its body is downloaded, since esa.io API cannot omit fields,
+    and the body is dropped afterwards so that it is not kept in metadata.
+
+    Return: (info, etag)
+      info ... dict without `body_md` and `body_html`, or None if the post is not modified
+    '''
+    logger.info('Getting post/{:d} (conditional)'.format(post_number))
+
+    client = get_client(token, team, proxy)
+
+    url = 'https://api.esa.io/v1/teams/{:s}/posts/{:d}'.format(team, post_number)
+    header = {}
+    if etag is not None:
+        header['If-None-Match'] = etag
+    if updated_at is not None:
+        try:
+            t = datetime.strptime(updated_at.replace(':', ''), '%Y-%m-%dT%H%M%S%z')
+            header['If-Modified-Since'] = format_datetime(t.astimezone(timezone.utc), usegmt=True)
+        except ValueError:
+            logger.debug('invalid updated_at: {:}'.format(updated_at))
+
+    res = client.get(url, headers=header)
+    if res.status_code == 304:
+        logger.info('post/{:d} is not modified.'.format(post_number))
+        return None, res.headers.get('ETag', etag)
+    if res.status_code == 404:
+        raise PostNotFound('post/{:d} is not found.'.format(post_number))
+    if res.status_code != 200:
+        logger.warning('Getting post failed.')
+        raise RuntimeError('Getting post failed.')
+    logger.info(res)
+
+    d = res.json()
+    d.pop('body_md', None)
+    d.pop('body_html', None)
+    logger.debug(d)
+
+    return d, res.headers.get('ETag', None)
+
+
 def create_post(body_md, token=None, team=None, name=None, tags=None, category=None, wip=True, message=None, proxy=None):
     logger.info('Creating new post')
 
     # post
-    _set_proxy(proxy)
+    client = get_client(token, team, proxy)
     url = 'https://api.esa.io/v1/teams/%s/posts' % team
-    header = {'Authorization': 'Bearer %s' % token,
-              'Content-Type': 'application/json'}
+    header = {'Content-Type': 'application/json'}
 
     params = dict(post=dict(name=name or "",
                             message=message or "Create post via esapy",
@@ -126,7 +201,7 @@ def create_post(body_md, token=None, team=None, name=None, tags=None, category=N
     if category is not None:
         params['post']['category'] = category
 
-    res = requests.post(url, headers=header, data=json.dumps(params))
+    res = client.post(url, headers=header, data=json.dumps(params))
     logger.debug(res)
 
     if res.status_code != 201:
@@ -144,10 +219,9 @@ def patch_post(post_number, body_md, token=None, team=None, name=None, tags=None
     logger.info('Updating post/{:d}'.format(post_number))
 
     # post
-    _set_proxy(proxy)
+    client = get_client(token, team, proxy)
     url = 'https://api.esa.io/v1/teams/{:s}/posts/{:d}'.format(team, post_number)
-    header = {'Authorization': 'Bearer {:s}'.format(token),
-              'Content-Type': 'application/json'}
+    header = {'Content-Type': 'application/json'}
 
     params = dict(post=dict(name=name or "",
                             message=message or "Update post via esapy",
@@ -160,7 +234,7 @@ def patch_post(post_number, body_md, token=None, team=None, name=None, tags=None
     if category is not None:
         params['post']['category'] = category
 
-    res = requests.patch(url, headers=header, data=json.dumps(params))
+    res = client.patch(url, headers=header, data=json.dumps(params))
     logger.debug(res)
 
     if res.status_code != 200:
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 
 import os
+import io
+import threading
 from pathlib import Path
 import mimetypes
-import requests
 import json
 import uuid
-from urllib.parse import quote
 import hashlib
 
 # logger
@@ -14,32 +14,81 @@ from logging import getLogger
 logger = getLogger(__name__)
 
 from .loadrc import KEY_GROWI_USERNAME
+from .httpclient import HttpClient, ClientRegistry
+from .multipart import log_progress
 
 
-def _set_proxy(proxy):
-    if proxy is None:
-        logger.debug('No proxy is addressed.')
-        return
+class GrowiClient(HttpClient):
+    '''pooled session for a growi instance
+
+    The access token is attached to every request as a query parameter.
+    '''
+
+    def __init__(self, token, url, proxy=None):
+        super().__init__(params=dict(access_token=token), proxy=proxy)
+        self.url = url
+        self.upload_page_ids = {}  # key=username, value=page_id to which attachments are added
+        self._page_lock = threading.Lock()
+
+
+_registry = ClientRegistry(GrowiClient)
+
 
-    logger.info('Addressed proxy: %s' % proxy)
-    os.environ['HTTP_PROXY'] = proxy
-    logger.debug('HTTP_PROXY={:s}'.format(os.environ['HTTP_PROXY']))
-    os.environ['HTTPS_PROXY'] = proxy
-    logger.debug('HTTPS_PROXY={:s}'.format(os.environ['HTTPS_PROXY']))
+def get_client(token=None, url=None, proxy=None):
+    '''return the client shared by all calls for (token, url, proxy)
+    '''
+    return _registry.get(token, url, proxy)
 
 
 def _get_growi_username():
     return os.environ[KEY_GROWI_USERNAME]
 
 
+def get_upload_page_id(token=None, url=None, proxy=None, refresh=False):
+    '''page_id of the user page to which attachments are added
+
+    The page is looked up once per (url, user) and memoized in the client.
+    '''
+    client = get_client(token, url, proxy)
+    username = _get_growi_username()
+    with client._page_lock:
+        if refresh:
+            client.upload_page_ids.pop(username, None)
+        if username not in client.upload_page_ids:
+            client.upload_page_ids[username] = get_post_by_path('/user/' + username, token, url, proxy)['_id']
+        return client.upload_page_ids[username]
+
+
+def load_upload_page(info, token=None, url=None, proxy=None):
+    '''seed the memo with a page recorded by `dump_upload_page` in a previous run
+
+    The record is ignored if it was made for another url or user.
+    '''
+    if not info or info.get('url') != url or info.get('user') != _get_growi_username():
+        return
+    client = get_client(token, url, proxy)
+    with client._page_lock:
+        client.upload_page_ids.setdefault(info['user'], info['page_id'])
+    logger.debug('page_id of user page is loaded: {:}'.format(info['page_id']))
+
+
+def dump_upload_page(token=None, url=None, proxy=None):
+    '''dict(url, user, page_id) of the memoized page, or None if it has not been looked up
+    '''
+    username = _get_growi_username()
+    page_id = get_client(token, url, proxy).upload_page_ids.get(username, None)
+    if page_id is None:
+        return None
+    return dict(url=url, user=username, page_id=page_id)
+
+
 def get_team_stats(token=None, url=None, proxy=None):
     logger.info('Getting healthcheck of growi')
 
-    _set_proxy(proxy)
+    client = get_client(token, url, proxy)
 
     # get metadata
-    res = requests.get(url + '/_api/v3/statistics/user',
-                       params=dict(access_token=token))
+    res = client.get(url + '/_api/v3/statistics/user')
     logger.debug(res)
     logger.debug(res.headers)
     if res.status_code == 200:
@@ -51,28 +100,35 @@ def get_team_stats(token=None, url=None, proxy=None):
     return res.json()
 
 
-def upload_binary(filename, token=None, url=None, proxy=None):
+def upload_binary(filename, token=None, url=None, proxy=None, progress=None, data=None):
+    '''upload a file as an attachment of the user page
+
+    The file is streamed in chunks.
+    If `data` (bytes) is given, it is uploaded from memory and `filename` is used only as its name.
+    `progress(bytes_sent, total)` is called during sending, default is logging.
+    '''
     path_bin = Path(filename)
     logger.info('Uploading binary data, path=%s' % str(path_bin))
-    logger.info('  filesize: %d' % path_bin.stat().st_size)
-
-    _set_proxy(proxy)
+    logger.info('  filesize: %d' % (len(data) if data is not None else path_bin.stat().st_size))
 
-    page_id = get_post_by_path('/user/' + _get_growi_username(), token, url, proxy)['_id']
+    client = get_client(token, url, proxy)
 
     # upload file
     logger.info('Posting binary...{:}'.format(path_bin.name))
-    with path_bin.open('rb') as imgfile:
-        res = requests.post(url + '/_api/attachments.add',
-                            data=dict(page_id=page_id,
-                                      access_token=token),
-                            files=dict(file=(path_bin.name,
-                                             imgfile,
-                                             mimetypes.guess_type(path_bin)[0]))
-                            )
-    logger.debug(res.headers)
-
-    if res.status_code != 200:
+    mtype = mimetypes.guess_type(str(path_bin))[0]
+    mtype = mtype if mtype is not None else 'application/octet-stream'
+    progress = progress if progress is not None else log_progress(path_bin.name)
+
+    page_id = get_upload_page_id(token, url, proxy)
+    res = _add_attachment(client, url, page_id, path_bin, mtype, progress, data)
+    if res is None:
+        # the memoized page may have been removed, so look it up again
+        logger.info('Retrying with the latest page_id of the user page')
+        page_id_new = get_upload_page_id(token, url, proxy, refresh=True)
+        if page_id_new != page_id:
+            res = _add_attachment(client, url, page_id_new, path_bin, mtype, progress, data)
+
+    if res is None:
         logger.warning('Upload failed, %s' % str(path_bin))
         raise RuntimeError('Upload failed.')
 
@@ -82,15 +138,78 @@ def upload_binary(filename, token=None, url=None, proxy=None):
     return image_url, res
 
 
+def _add_attachment(client, url, page_id, path_bin, mtype, progress, data=None):
+    '''post a file to attachments.add, return response or None if failed
+    '''
+    with (io.BytesIO(data) if data is not None else path_bin.open('rb')) as imgfile:
+        res = client.post_multipart(url + '/_api/attachments.add',
+                                    [('page_id', page_id)],
+                                    ('file', path_bin.name, imgfile, mtype),
+                                    callback=progress)
+    logger.debug(res.headers)
+
+    if res.status_code != 200:
+        return None
+    try:
+        d = res.json()
+    except ValueError:
+        return None
+    if not d.get('ok', True) or 'attachment' not in d:
+        logger.info('attachments.add failed: {:}'.format(d.get('error', '')))
+        return None
+    return res
+
+
+def is_alive(attachment_url, token=None, url=None, proxy=None):
+    '''check an attachment url (relative to `url`), see `HttpClient.is_alive`
+    '''
+    if attachment_url.startswith('/'):
+        attachment_url = url + attachment_url
+    return get_client(token, url, proxy).is_alive(attachment_url)
+
+
+def _update_page(client, url, page_id, body_md, revision_id):
+    '''post to pages.update, return response or None if the revision is outdated
+    '''
+    payload = {'body': body_md,
+               'page_id': page_id,
+               'revision_id': revision_id
+               }
+    logger.debug(dict(payload, body='<not shown>'))
+    res = client.post(url + '/_api/pages.update',
+                      data=payload,
+                      )
+    logger.debug(res)
+
+    if res.status_code == 409:
+        return None
+    if res.status_code == 200:
+        d = res.json()
+        if not d.get('ok', True) and 'outdated' in (str(d.get('code', '')) + str(d.get('error', ''))):
+            return None
+    return res
+
+
+def get_revision_id(d):
+    '''revision id in a response of create/update page, or None
+    '''
+    d = d.get('data', d)  # response of v3 api is wrapped in `data`
+    rev = d.get('revision', None)
+    if rev is None:
+        rev = d.get('page', {}).get('revision', None)
+    if isinstance(rev, dict):
+        rev = rev.get('_id', None)
+    return rev
+
+
 def get_post(page_id, token=None, url=None, proxy=None):
     logger.info('Getting post/{:}'.format(page_id))
 
     # post
-    _set_proxy(proxy)
-    payload = {'access_token': token,
-               'page_id': page_id}
-    res = requests.get(url + '/_api/pages.get',
-                       params=payload)
+    client = get_client(token, url, proxy)
+    payload = {'page_id': page_id}
+    res = client.get(url + '/_api/pages.get',
+                     params=payload)
     logger.debug(res)
 
     if res.status_code != 200:
@@ -106,12 +225,11 @@ def get_post(page_id, token=None, url=None, proxy=None):
 def get_post_by_path(pagepath, token=None, url=None, proxy=None):
     logger.info('Getting post/{:}'.format(pagepath))
 
-    _set_proxy(proxy)
+    client = get_client(token, url, proxy)
 
-    payload = {'access_token': token,
-               'path': pagepath}
-    res = requests.get(url + '/_api/pages.get',
-                       params=payload)
+    payload = {'path': pagepath}
+    res = client.get(url + '/_api/pages.get',
+                     params=payload)
     logger.debug(res)
     logger.debug(res.headers)
     # logger.debug(res.text)
@@ -130,16 +248,15 @@ def create_post(body_md, token=None, url=None, name=None, proxy=None):
     logger.info('Creating new post')
 
     # post
-    _set_proxy(proxy)
+    client = get_client(token, url, proxy)
 
     if name is None:
         raise RuntimeError('`name` is required.')
 
-    payload = {'access_token': token,
-               'body': body_md,
+    payload = {'body': body_md,
                'path': '/user/' + _get_growi_username() + '/' + name}
-    res = requests.post(url + '/_api/v3/pages/',
-                        data=payload)
+    res = client.post(url + '/_api/v3/pages/',
+                      data=payload)
     logger.debug(res)
     logger.debug(res.headers)
 
@@ -157,24 +274,27 @@ def create_post(body_md, token=None, url=None, name=None, proxy=None):
     return pageurl, res
 
 
-def patch_post(page_id, body_md, name, token=None, url=None, proxy=None):
+def patch_post(page_id, body_md, name, token=None, url=None, proxy=None, revision_id=None):
+    '''update a page
+
+    `revision_id` returned by the previous create/update is used optimistically.
+    The latest revision is fetched only when it is not given or rejected as stale.
+    '''
     logger.info('Updating post: {:}'.format(page_id))
 
-    page_dat = get_post(page_id, token, url, proxy)
+    client = get_client(token, url, proxy)
 
-    # post
-    _set_proxy(proxy)
-    payload = {'body': body_md,
-               'page_id': page_id,
-               'revision_id': page_dat['revision']['_id']
-               }
-    logger.debug(payload)
-    res = requests.post(url + f'/_api/pages.update?access_token={quote(token)}',
-                        data=payload,
-                        )
-    logger.debug(res)
+    res = None
+    if revision_id is not None:
+        res = _update_page(client, url, page_id, body_md, revision_id)
+        if res is None:
+            logger.info('revision_id={:} is outdated. -> getting the latest revision'.format(revision_id))
 
-    if res.status_code != 200:
+    if res is None:
+        page_dat = get_post(page_id, token, url, proxy)
+        res = _update_page(client, url, page_id, body_md, page_dat['revision']['_id'])
+
+    if res is None or res.status_code != 200:
         raise RuntimeError('Create post failed.')
 
     d = res.json()
@@ -6,9 +6,10 @@ import webbrowser
 import sys
 
 from .processor import MarkdownProcessor, TexProcessor, IpynbProcessor
-from .loadrc import _show_configuration, get_token_and_team, RCFILE, KEY_TOKEN, KEY_TEAM
+from .loadrc import _show_configuration, get_token_and_team, get_network_config, get_cache_config, get_render_cache_config, parse_bytes, RCFILE, KEY_TOKEN, KEY_TEAM
 from . import api_growi
 from . import api_esa
+from .httpclient import collect_stats, configure
 from .helper import reset_ipynb, ls_dir_or_file, get_version
 
 # logger
@@ -39,6 +40,8 @@ def command_up(args):
         args_dict['team'] = team
     elif dest == 'growi':
         args_dict['url'] = team
+    args_dict['upload_cache'] = get_cache_config(args)
+    args_dict['render_cache'] = get_render_cache_config(args)
 
     # process start
     browser_flg = False  # flag to open browser after uploading body
@@ -67,10 +70,22 @@ def command_up(args):
                 tb = sys.exc_info()[2]
                 logger.warn(e)
                 logger.warn(e.with_traceback(tb))
+                proc.summary['publish'] = 'failed'
 
         # finalize
         proc.save()
 
+    print('summary ... images: {images_uploaded:d} uploaded, {images_reused:d} reused, '
+          '{images_deferred:d} deferred, {images_failed:d} failed / '
+          'cells: {cells_reused:d} reused, {cells_rebuilt:d} rebuilt / post: {publish:s}'.format(**proc.summary))
+
+    # network statistics
+    logger.info('network: {requests:d} requests, {retries:d} retries, '
+                'waited {wait_ratelimit:.1f} sec for rate limit and {wait_backoff:.1f} sec for backoff'
+                .format(**collect_stats()))
+    logger.info('network: {bytes_sent:d} bytes uploaded, throttled {wait_bandwidth:.1f} sec by bandwidth limit'
+                .format(**collect_stats()))
+
     # if succeeded, open browser in edit page
     if browser_flg:
         if dest == 'esa':
@@ -114,7 +129,7 @@ def command_config(args):
 
 
 def command_reset(args):
-    reset_ipynb(args.target, args.number, args.clear_hashdict)
+    reset_ipynb(args.target, args.number, args.clear_hashdict, get_cache_config(args))
 
 
 def command_ls(args):
@@ -138,11 +153,22 @@ g_up_output.add_argument('--destructive', action='store_true', default=True, hel
 g_up_output.add_argument('--output', metavar='<output_filepath>', help='output filename')
 g_up_output.add_argument('--no-output', action='store_true', help='work on temporary file')
 parser_up.add_argument('--leave-temp', action='store_true', help='leave temporary files')
+parser_up.add_argument('--no-render-cache', action='store_true', help='render every cell of notebook without the cache of rendered cells (rcfile key: render_cache)')
+parser_up.add_argument('--no-upload-cache', action='store_true', help='neither look up nor record uploaded files in the cache shared by all notebooks (rcfile key: upload_cache)')
 
 g_up_mode = parser_up.add_argument_group('optional arguments for mode config')
 g_up_mode.add_argument('--folding-mode', type=str, choices=['auto', 'as-shown', 'ignore'], default='auto', help='default is auto. ignore: any details tag will be set as open, as-shown: details tags obey metadata of each cell, auto: source block of code-cell starting from "plt.figure" will be closed.')
 g_up_mode.add_argument('--publish-mode', type=str, choices=['force', 'check', 'skip'], default='force', help='default is force. force: publish body even if uploading images failed, check: publish body when uploading succeeded, skip: create no post')
 g_up_mode.add_argument('--post-mode', type=str, choices=['auto', 'new'], default='auto', help='default is auto. auto: when the file has been already uploaded, update the post (this function only for ipynb input), new: create new post always')
+g_up_mode.add_argument('--post-lookup', type=str, choices=['always', 'conditional', 'never'], default='conditional', help='default is conditional. how to check attributes of the uploaded post (esa.io) before update. always: download the post, conditional: download it only if modified since the last lookup, never: trust post_info in notebook metadata')
+g_up_mode.add_argument('--image-hash', type=str, choices=['bytes', 'pixels'], default='bytes', help='default is bytes. how to identify uploaded images. bytes: sha256 of file, pixels: content of png image ignoring metadata and compression, so re-executed figures are not uploaded again')
+g_up_mode.add_argument('--hash-algorithm', type=str, choices=['sha256', 'blake2b'], default='sha256', help='default is sha256. hash of files to identify uploaded images. blake2b is faster, but images uploaded with sha256 are uploaded again once')
+g_up_mode.add_argument('--force-update', action='store_true', help='publish even if the body and attributes of the post are unchanged since the previous publish')
+g_up_mode.add_argument('--validate-urls', metavar='<ratio>', type=float, nargs='?', const=1.0, help='check urls of uploaded images with HEAD requests, and upload images which are removed on the server again. Only <ratio> (default 1.0) of urls which are not checked within 7 days are checked.')
+g_up_mode.add_argument('--upload-workers', metavar='<num>', type=int, default=4, help='default is 4. number of images uploaded concurrently')
+g_up_mode.add_argument('--jobs', metavar='<num>', type=int, default=1, help='default is 1. number of processes converting cells of notebook. Notebooks smaller than --parallel-threshold are converted in a single process')
+g_up_mode.add_argument('--parallel-threshold', metavar='<size>', type=parse_bytes, default=parse_bytes('1M'), help='default is 1M. characters of cells to be converted, below which --jobs is ignored')
+g_up_mode.add_argument('--deadline', metavar='<sec>', type=float, help='overall time limit of network access. When it expires, remaining uploads are cancelled and metadata of finished uploads is saved. (rcfile key: deadline)')
 g_up_browse = g_up_mode.add_mutually_exclusive_group()
 g_up_browse.add_argument('--open-browser', dest='browser', action='store_true', default=True, help='[default] open edit page on browser after publish')
 g_up_browse.add_argument('--no-browser', dest='browser', action='store_false', help='skip opening edit page')
@@ -172,7 +198,7 @@ parser_reset = subparsers.add_parser('reset', help='reset metadata',
 parser_reset.set_defaults(handler=command_reset)
 parser_reset.add_argument('target', metavar='<filepath>.ipynb', help='notebook file which you want to reset')
 parser_reset.add_argument('--number', metavar='<post_number>', type=int, help='post_number to newly set')
-parser_reset.add_argument('--clear-hashdict', action='store_true', help='clear hashdict (map of uploaded images and urls)')
+parser_reset.add_argument('--clear-hashdict', action='store_true', help='clear hashdict (map of uploaded images and urls), and remove the images from the upload cache so that they are uploaded again')
 
 # ls
 parser_ls = subparsers.add_parser('ls', help='show ipynb file list',
@@ -188,6 +214,9 @@ g_up_network = parser.add_argument_group('optional arguments for network config'
 g_up_network.add_argument('--token', metavar='<esa.io_token>', help='your access token for esa.io (read/write required)')
 g_up_network.add_argument('--team', metavar='<esa.io_team_name>', help='`***` of `https://***.esa.io/`')
 g_up_network.add_argument('--proxy', metavar='<url>:<port>')
+g_up_network.add_argument('--connect-timeout', metavar='<sec>', type=float, help='timeout for connecting to server, default is 10 (rcfile key: connect_timeout)')
+g_up_network.add_argument('--bandwidth', metavar='<bytes/sec>', help='upper limit of upload throughput, e.g. 500K or 2M (rcfile key: bandwidth)')
+g_up_network.add_argument('--read-timeout', metavar='<sec>', type=float, help='timeout for waiting response, default is 60 (rcfile key: read_timeout)')
 parser.add_argument('--verbose', '-v', action='count', default=0)
 
 
@@ -209,6 +238,9 @@ def main():
     logger.info('verbose level={:d}'.format(args.verbose))
     logger.debug('args={:s}'.format(str(args)))
 
+    # network settings
+    configure(**get_network_config(args))
+
     # call each function
     if hasattr(args, 'handler'):
         args.handler(args)
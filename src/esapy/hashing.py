@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import hashlib
+import struct
+import threading
+import zlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CONTENT_CHUNKS = (b'IHDR', b'PLTE', b'tRNS')  # chunks which change appearance, except IDAT
+
+
+def png_fingerprint(data):
+    '''hash of the image content of a PNG, which ignores how the file was written
+
+    Ancillary chunks (tEXt, iTXt, tIME, pHYs, ...) are ignored, and IDAT chunks are
+    hashed after decompression, so zlib level and IDAT splitting do not matter.
+    Scanlines are not unfiltered: re-encoding with another filter strategy gives another fingerprint.
+
+    Return: 'png:<sha256>', or None if data is not a valid PNG
+    '''
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+
+    m = hashlib.sha256()
+    d = zlib.decompressobj()
+    pos = len(PNG_SIGNATURE)
+    try:
+        while pos + 8 <= len(data):
+            length, ctype = struct.unpack('>I4s', data[pos:pos + 8])
+            body = data[pos + 8:pos + 8 + length]
+            if len(body) != length:
+                return None
+            if ctype in PNG_CONTENT_CHUNKS:
+                m.update(ctype + body)
+            elif ctype == b'IDAT':
+                m.update(d.decompress(body))
+            elif ctype == b'IEND':
+                break
+            pos += 12 + length  # length, type, body, crc
+        else:
+            return None  # truncated
+        m.update(d.flush())
+    except (struct.error, zlib.error) as e:
+        logger.debug('invalid png: {:}'.format(e))
+        return None
+    if not d.eof:
+        return None
+
+    return 'png:' + m.hexdigest()
+
+
+HASH_ALGORITHMS = ('sha256', 'blake2b')
+CHUNK_SIZE = 1 << 20
+
+
+def _new_hash(algorithm):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('unsupported hash algorithm: {:s}'.format(algorithm))
+    return hashlib.new(algorithm)
+
+
+def _to_key(m, algorithm):
+    '''sha256 is not prefixed, for compatibility with hashdict written by older versions
+    '''
+    return m.hexdigest() if algorithm == 'sha256' else algorithm + ':' + m.hexdigest()
+
+
+def hash_bytes(data, algorithm='sha256'):
+    m = _new_hash(algorithm)
+    m.update(data)
+    return _to_key(m, algorithm)
+
+
+def hash_file(path, algorithm='sha256', chunk_size=CHUNK_SIZE):
+    '''hash a file reading it chunk by chunk into a reused buffer
+    '''
+    m = _new_hash(algorithm)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(str(path), 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            m.update(view[:n])
+    return _to_key(m, algorithm)
+
+
+class FileHasher(object):
+    '''hash files with a memo keyed on (path, size, mtime_ns, inode)
+
+    Unchanged files are never read again. The memo lives in this object and,
+    if `store` (UploadCache) is given, persists across runs.
+    `hash_files` hashes many files on a thread pool.
+
+    Parameters
+    ----------
+    algorithm : 'sha256' or 'blake2b'
+    image_hash : 'bytes' or 'pixels'
+        pixels: png files are keyed by `png_fingerprint`
+    '''
+
+    def __init__(self, algorithm='sha256', image_hash='bytes', store=None, max_workers=4):
+        self.algorithm = algorithm
+        self.image_hash = image_hash
+        self.scheme = algorithm if image_hash == 'bytes' else 'pixels/' + algorithm
+        self.store = store
+        self.max_workers = max_workers
+        self.hits = self.misses = 0
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def hash_data(self, data):
+        '''key of bytes in memory
+        '''
+        if self.image_hash == 'pixels':
+            h = png_fingerprint(data)
+            if h is not None:
+                return h
+        return hash_bytes(data, self.algorithm)
+
+    def hash(self, path):
+        p = Path(path).resolve()
+        st = p.stat()
+        key = (str(p), st.st_size, st.st_mtime_ns, st.st_ino)
+
+        with self._lock:
+            h = self._memo.get(key, None)
+        if h is None and self.store is not None:
+            h = self.store.get_digest(key, self.scheme)
+        if h is not None:
+            with self._lock:
+                self.hits += 1
+                self._memo[key] = h
+            return h
+
+        if self.image_hash == 'pixels':
+            with p.open('rb') as f:
+                h = self.hash_data(f.read())
+        else:
+            h = hash_file(p, self.algorithm)
+
+        with self._lock:
+            self.misses += 1
+            self._memo[key] = h
+        if self.store is not None:
+            self.store.put_digest(key, self.scheme, h)
+        return h
+
+    def hash_files(self, paths):
+        '''hash files in parallel, return dict path -> key (files which cannot be read are skipped)
+        '''
+        paths = list(dict.fromkeys(paths))  # unique, keeping order
+
+        def _hash(p):
+            try:
+                return p, self.hash(p)
+            except OSError as e:
+                logger.debug('hashing {:s} failed: {:}'.format(str(p), e))
+                return p, None
+
+        if len(paths) <= 1:
+            res = [_hash(p) for p in paths]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+                res = list(ex.map(_hash, paths))
+        logger.debug('hashing files: {:d} hits, {:d} misses'.format(self.hits, self.misses))
+        return {p: h for p, h in res if h is not None}
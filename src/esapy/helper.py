@@ -3,14 +3,20 @@
 from pathlib import Path
 import json
 
+from .uploadcache import UploadCache, UploadJournal
+
 # logger
 from logging import getLogger, basicConfig, DEBUG, INFO
 logger = getLogger(__name__)
 
 
-def reset_ipynb(target, post_number=None, clear_hashdict=False):
+def reset_ipynb(target, post_number=None, clear_hashdict=False, upload_cache=None):
     '''Remove metadata in <target> ipynb file,
     and write post_number in it if assigned.
+
+    With `clear_hashdict`, images and the notebook uploaded from it are also removed
+    from the upload cache (settings given by `upload_cache`), so that they are uploaded again.
+    The journal of uploads of an interrupted run is cleared, too.
     '''
     logger.info('subcommand `Reset`')
     logger.info('  target={:s}'.format(target))
@@ -36,11 +42,20 @@ def reset_ipynb(target, post_number=None, clear_hashdict=False):
     if clear_hashdict:
         h_dict = {}
         logger.info('Hash dict was cleared.')
+        if upload_cache is not None:
+            hashes = list(j['metadata']['esapy'].get('hashdict', {}).keys())
+            hashes.append(j['metadata']['esapy'].get('ipynb_attachment', {}).get('hash', None))
+            with UploadCache(**upload_cache) as c:
+                n = c.forget([h for h in hashes if h is not None])
+            logger.info('{:d} entries were removed from upload cache.'.format(n))
     else:
         h_dict = j['metadata']['esapy'].get('hashdict', {})
         logger.info('Hash dict was stashed.')
     logger.debug(h_dict)
 
+    # uploads of an interrupted run are not resumed
+    UploadJournal(path_target, (upload_cache or {}).get('cache_dir', None)).clear()
+
     # reset
     j['metadata']['esapy'] = dict(hashdict=h_dict)
     logger.info('Metadata was reset.')
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import random
+import weakref
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+from .multipart import MultipartEncoder
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+# network settings shared by all clients in a run (updated by `configure`)
+config = dict(pool_size=10,
+              max_retries=5,  # retries of transient failures per request
+              backoff_base=1.0,  # [sec] first backoff window, doubled at each retry
+              backoff_max=60.0,  # [sec] upper bound of a backoff window
+              ratelimit_reserve=0.1,  # start pacing when remaining quota gets below this fraction
+              connect_timeout=10.0,  # [sec]
+              read_timeout=60.0,  # [sec] between bytes received
+              deadline=None,  # [sec] overall budget of a run, counted from `configure`
+              breaker_threshold=5,  # consecutive failures to open the circuit breaker of a destination
+              breaker_cooldown=30.0,  # [sec] requests fail fast during this period after opening
+              bandwidth=None,  # [bytes/sec] upper limit of upload throughput of the whole process
+              )
+
+RETRY_STATUS = (429, 502, 503, 504)
+UNPROCESSED_STATUS = (429, 503)  # the request was not processed, so retrying any method is safe
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+DEAD_STATUS = (404, 410)  # status of a removed resource
+
+_clients = weakref.WeakSet()
+_deadline_at = None  # time.monotonic() when the deadline expires
+
+
+def configure(**kwargs):
+    '''update network settings used by clients created afterwards
+
+    If `deadline` is given, the budget starts now and is shared by all requests in this process.
+    '''
+    global _deadline_at
+
+    for k, v in kwargs.items():
+        if k not in config:
+            raise KeyError('unknown network setting: {:s}'.format(k))
+        if v is not None:
+            config[k] = v
+    logger.debug('network config={:}'.format(config))
+
+    if kwargs.get('bandwidth', None) is not None:
+        bandwidth.set_rate(config['bandwidth'])
+
+    if kwargs.get('deadline', None) is not None:
+        _deadline_at = time.monotonic() + float(config['deadline'])
+        logger.info('deadline: {:.1f} sec'.format(float(config['deadline'])))
+
+
+def time_left():
+    '''seconds until the deadline, or None if no deadline is set
+    '''
+    if _deadline_at is None:
+        return None
+    return _deadline_at - time.monotonic()
+
+
+def check_deadline():
+    '''raise DeadlineExceeded if the deadline has expired
+    '''
+    t = time_left()
+    if t is not None and t <= 0:
+        raise DeadlineExceeded('Deadline of {:.1f} sec exceeded.'.format(float(config['deadline'])))
+
+
+def collect_stats():
+    '''sum up counters of all clients alive in this process, and of the bandwidth limiter
+    '''
+    d = HttpClient.empty_stats()
+    for c in list(_clients):
+        for k, v in c.stats.items():
+            d[k] += v
+    d['bytes_sent'] = bandwidth.consumed
+    d['wait_bandwidth'] = bandwidth.throttled
+    return d
+
+
+class TokenBucket(object):
+    '''token bucket limiting throughput in bytes/sec
+
+    Consumers take tokens for each chunk before sending it, and sleep while the
+    bucket is in debt. The bucket is shared by threads, so the limit applies to
+    all uploads in flight. `rate=None` means unlimited.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.consumed = 0  # [bytes]
+        self.throttled = 0.0  # [sec] total time slept
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = float(rate) if rate else None
+            self.burst = float(burst) if burst is not None else self.rate  # 1 sec of traffic
+            self.tokens = self.burst
+            self.last = time.monotonic()
+        logger.debug('bandwidth limit: {:} bytes/sec'.format(self.rate))
+
+    def consume(self, n):
+        '''take n tokens, sleeping until the bucket can afford them
+        '''
+        with self._lock:
+            self.consumed += n
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - n
+            self.last = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.throttled += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+bandwidth = TokenBucket()  # shared by all uploads in this process
+
+
+class NetworkError(RuntimeError):
+    '''connection-level failure, raised after retries were exhausted'''
+    pass
+
+
+class DeadlineExceeded(RuntimeError):
+    '''the overall deadline of the run has expired, remaining requests are cancelled'''
+    pass
+
+
+class DestinationUnavailable(RuntimeError):
+    '''the destination keeps failing and requests are not sent until cool-down'''
+    pass
+
+
+class CircuitBreaker(object):
+    '''stop sending requests to a destination which keeps failing
+
+    The breaker opens after `breaker_threshold` consecutive failures, and requests
+    fail fast with DestinationUnavailable for `breaker_cooldown` sec.
+    After that, requests are let through again; one success closes the breaker
+    and one failure opens it again.
+    '''
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None \
+                and time.monotonic() - self.opened_at < config['breaker_cooldown']
+
+    def check(self):
+        if self.is_open:
+            raise DestinationUnavailable('Destination is unavailable after {:d} consecutive failures.'
+                                         .format(self.failures))
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('circuit breaker closed.')
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= config['breaker_threshold']:
+                if self.opened_at is None:
+                    logger.warning('circuit breaker opened after {:d} consecutive failures.'.format(self.failures))
+                self.opened_at = time.monotonic()
+
+
+class RateLimit(object):
+    '''request quota of a host, tracked from `X-RateLimit-*` response headers
+    '''
+
+    def __init__(self):
+        self.limit = self.remaining = self.reset = None
+        self._lock = threading.Lock()
+
+    def update(self, headers):
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = float(headers['X-RateLimit-Reset'])  # epoch time
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self.limit, self.remaining, self.reset = limit, remaining, reset
+        logger.debug('rate limit: {:d}/{:d}, reset at {:.0f}'.format(remaining, limit, reset))
+
+    def acquire(self, now=None):
+        '''consume one request from the quota and return seconds to wait before sending it
+
+        Requests are spread over the rest of the window once the remaining quota
+        gets below `ratelimit_reserve`, and held until reset when it is exhausted.
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.remaining is None or self.reset is None or self.reset <= now:
+                return 0.0
+            window = self.reset - now
+            remaining = self.remaining
+            self.remaining -= 1
+
+        if remaining <= 0:
+            return window
+        if remaining > max(1, self.limit * config['ratelimit_reserve']):
+            return 0.0
+        return window / remaining
+
+
+def _retry_after(res):
+    '''seconds in `Retry-After` header (delta-seconds or HTTP-date), or None
+    '''
+    v = res.headers.get('Retry-After')
+    if v is None:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    '''full-jitter exponential backoff for the `attempt`-th retry (0-origin)
+    '''
+    window = min(config['backoff_max'], config['backoff_base'] * 2 ** attempt)
+    return random.uniform(0, window)
+
+
+def _file_positions(kwargs):
+    '''remember offsets of file objects in request body to rewind them before retrying
+    '''
+    objs = []
+    files = kwargs.get('files') or {}
+    for v in (files.values() if isinstance(files, dict) else [x[1] for x in files]):
+        objs.append(v[1] if isinstance(v, (tuple, list)) else v)
+    objs.append(kwargs.get('data'))
+    return [(f, f.tell()) for f in objs if hasattr(f, 'seek') and hasattr(f, 'tell')]
+
+
+class HttpClient(object):
+    '''keep-alive http session bound to a single destination
+
+    A pooled `requests.Session` carries auth, proxy and pool-size settings,
+    so that TCP/TLS connections are reused across all calls in a run.
+    '''
+
+    def __init__(self, headers=None, params=None, proxy=None, pool_size=None):
+        self.pool_size = pool_size if pool_size is not None else config['pool_size']
+        self.session = requests.Session()
+        self.ratelimits = {}  # key=host, value=RateLimit
+        self.breakers = {}  # key=host, value=CircuitBreaker
+        self.stats = self.empty_stats()
+        self._lock = threading.Lock()
+        _clients.add(self)
+
+        self._mount_adapter()
+
+        if headers is not None:
+            self.session.headers.update(headers)
+        if params is not None:
+            self.session.params.update(params)
+
+        if proxy is None:
+            logger.debug('No proxy is addressed.')
+        else:
+            logger.info('Addressed proxy: %s' % proxy)
+            self.session.proxies.update(http=proxy, https=proxy)
+
+    def _mount_adapter(self):
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def ensure_pool_size(self, pool_size):
+        '''grow connection pool so that `pool_size` requests can be in flight at once
+        '''
+        if pool_size > self.pool_size:
+            logger.debug('pool size: {:d} -> {:d}'.format(self.pool_size, pool_size))
+            self.pool_size = pool_size
+            self._mount_adapter()
+
+    @staticmethod
+    def empty_stats():
+        return dict(requests=0,
+                    retries=0,
+                    wait_ratelimit=0.0,  # [sec] pacing ahead of quota exhaustion
+                    wait_backoff=0.0,  # [sec] backoff before retrying
+                    )
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _wait(self, key, sec):
+        if sec <= 0:
+            return
+        t = time_left()
+        if t is not None and sec >= t:
+            raise DeadlineExceeded('Deadline would expire while waiting {:.1f} sec ({:s}).'.format(sec, key))
+        logger.info('waiting {:.1f} sec ({:s})'.format(sec, key))
+        self._count(key, sec)
+        time.sleep(sec)
+
+    def _timeout(self, timeout=None):
+        '''(connect, read) timeout, shortened to the time left until the deadline
+        '''
+        if timeout is None:
+            timeout = (config['connect_timeout'], config['read_timeout'])
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        t = time_left()
+        if t is None:
+            return timeout
+        return tuple(min(x, t) if x is not None else t for x in timeout)
+
+    def is_available(self, url):
+        '''False while the circuit breaker of the host of `url` is open
+        '''
+        return not self._get_breaker(url).is_open
+
+    def _get_ratelimit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self.ratelimits:
+                self.ratelimits[host] = RateLimit()
+            return self.ratelimits[host]
+
+    def _get_breaker(self, url):
+        '''circuit breaker of the host, so that an outage of the storage does not block the API
+        '''
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker()
+            return self.breakers[host]
+
+    def request(self, method, url, **kwargs):
+        '''send a request, pacing by rate limit and retrying transient failures
+
+        Responses with RETRY_STATUS are retried with jittered exponential backoff.
+        Non-idempotent methods are retried only on UNPROCESSED_STATUS, because a request
+        which got 502/504 from a gateway may have been processed (e.g. a post was created).
+        Connection errors and timeouts are retried only for idempotent methods.
+        The last response is returned as is, so that callers can check its status.
+        DeadlineExceeded is raised once the deadline of the run has expired,
+        and DestinationUnavailable while the circuit breaker of the host is open.
+        '''
+        ratelimit = self._get_ratelimit(url)
+        breaker = self._get_breaker(url)
+        positions = _file_positions(kwargs)
+        timeout = kwargs.pop('timeout', None)
+
+        attempt = 0
+        while True:
+            check_deadline()
+            breaker.check()
+            self._wait('wait_ratelimit', ratelimit.acquire())
+
+            logger.debug('{:s} {:s}'.format(method, url))
+            self._count('requests')
+            try:
+                res = self.session.request(method, url, timeout=self._timeout(timeout), **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                if method.upper() not in IDEMPOTENT_METHODS or attempt >= config['max_retries']:
+                    raise NetworkError('{:s} {:s} failed: {:}'.format(method, url, e)) from e
+                logger.warning('{:s} {:s} failed: {:}'.format(method, url, e))
+                delay = backoff_delay(attempt)
+            else:
+                ratelimit.update(res.headers)
+                if res.status_code >= 500:
+                    breaker.record_failure()  # 429 is not a sign of outage
+                else:
+                    breaker.record_success()
+                if res.status_code not in RETRY_STATUS or attempt >= config['max_retries']:
+                    return res
+                if method.upper() not in IDEMPOTENT_METHODS and res.status_code not in UNPROCESSED_STATUS:
+                    logger.warning('{:s} {:s} returned {:d}, not retried since it may have been processed.'
+                                   .format(method, url, res.status_code))
+                    return res
+                logger.warning('{:s} {:s} returned {:d}'.format(method, url, res.status_code))
+                delay = max(backoff_delay(attempt), _retry_after(res) or 0.0)
+
+            attempt += 1
+            self._count('retries')
+            self._wait('wait_backoff', delay)
+            for f, pos in positions:
+                f.seek(pos)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def is_alive(self, url, **kwargs):
+        '''check a url with a HEAD request
+
+        Return: True, False if it is removed (404, 410), or None if unknown (other errors)
+        '''
+        try:
+            res = self.head(url, allow_redirects=False, **kwargs)
+        except RuntimeError as e:
+            logger.debug('checking {:s} failed: {:}'.format(url, e))
+            return None
+        if res.status_code in DEAD_STATUS:
+            return False
+        return True if res.status_code < 400 else None
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def post_multipart(self, url, fields, file, callback=None, headers=None, **kwargs):
+        '''post multipart/form-data streaming the file part in chunks
+
+        fields: list of (name, value), file: (name, filename, fileobj, content_type)
+        '''
+        body = MultipartEncoder(fields, file, callback=callback, throttle=bandwidth.consume)
+        headers = dict(headers or {}, **{'Content-Type': body.content_type})
+        return self.post(url, data=body, headers=headers, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class ClientRegistry(object):
+    '''memoize clients, one per destination, for the life of a run
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self._factory(*key)
+            return self._clients[key]
+
+    def clients(self):
+        return list(self._clients.values())
+
+    def close(self):
+        with self._lock:
+            for c in self._clients.values():
+                c.close()
+            self._clients.clear()
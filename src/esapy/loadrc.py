@@ -16,6 +16,9 @@ KEY_GROWI_URL = 'GROWI_URL'
 KEY_GROWI_USERNAME = 'GROWI_USERNAME'
 KEY_GROWI_TOKEN = 'GROWI_TOKEN'
 
+# network settings which can be written in rcfile, overridden by args of the same name
+RC_NETWORK_KEYS = ('connect_timeout', 'read_timeout', 'deadline', 'bandwidth')
+
 
 def _show_configuration():
     logger.info('showing configurations')
@@ -111,6 +114,60 @@ def _load_rcfile():
     return y
 
 
+def get_network_config(args):
+    """return dict of network settings, args > rcfile
+    """
+    y = _load_rcfile() or {}
+    d = {}
+    for k in RC_NETWORK_KEYS:
+        v = getattr(args, k, None)
+        d[k] = v if v is not None else y.get(k, None)
+    if d['bandwidth'] is not None:
+        d['bandwidth'] = parse_bytes(d['bandwidth'])
+    logger.debug('network settings={:}'.format(d))
+    return d
+
+
+def get_cache_config(args):
+    """return dict of settings for upload cache, or None if it is disabled
+
+    rcfile keys: upload_cache (bool), cache_dir, upload_cache_max_entries, upload_cache_max_age (days)
+    """
+    y = _load_rcfile() or {}
+    if getattr(args, 'no_upload_cache', False) or not y.get('upload_cache', True):
+        logger.info('upload cache is disabled.')
+        return None
+    return dict(cache_dir=y.get('cache_dir', None),
+                max_entries=y.get('upload_cache_max_entries', 100000),
+                max_age=y.get('upload_cache_max_age', 180))
+
+
+def get_render_cache_config(args):
+    """return dict of settings for render cache of notebook cells, or None if it is disabled
+
+    rcfile keys: render_cache (bool), cache_dir, render_cache_max_entries
+    """
+    y = _load_rcfile() or {}
+    if getattr(args, 'no_render_cache', False) or not y.get('render_cache', True):
+        logger.info('render cache is disabled.')
+        return None
+    return dict(cache_dir=y.get('cache_dir', None),
+                max_entries=y.get('render_cache_max_entries', 20000))
+
+
+def parse_bytes(s):
+    """'500K', '1.5M', '2G' or number -> int in bytes (1K = 1024)
+    """
+    s = str(s).strip()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    try:
+        if s[-1:].upper() in units:
+            return int(float(s[:-1]) * units[s[-1].upper()])
+        return int(float(s))
+    except ValueError:
+        raise ValueError('invalid size: {:s}'.format(s))
+
+
 def _get_token_from_rcfile():
     x = None
 
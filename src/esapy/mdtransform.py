@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import re
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+# Note: ファイル名にカッコ()が入っていると正規表現に失敗する。
+# TODO: regexパッケージを使えば入れ子のマッチ対処できるらしい
+RE_IMAGE = re.compile(r'!\[(.*?)\]\((.+?)\)')
+
+# tokens to be escaped in inline math, matched in one pass
+# a backslash preceded by a backslash is the second of a pair, which is not escaped again
+_INLINE_MATH_TOKENS = (r'(?P<backslashes>\\\\)'  # '\\' -> '\\\\' (escaping line break)
+                       r'|(?<!\\)\\(?P<space>\s)'  # '\ ' -> '\\ ' (escaping hspace)
+                       r'|(?<!\\)\\(?P<symbol>[_,!#%&{}])'  # '\%' -> '\\%' など
+                       r'|(?P<asterisk>\*)'  # '*' -> '\ast'
+                       r"|(?<!\^)(?P<prime>')")  # "'" -> '^\prime'
+RE_INLINE_MATH = re.compile(_INLINE_MATH_TOKENS)
+RE_INLINE_MATH_ESA = re.compile(_INLINE_MATH_TOKENS + r'|(?<!\\)(?P<underscore>_)')  # 'a_i' -> 'a\_i'
+
+_REPLACEMENTS = dict(backslashes='\\\\\\\\',
+                     space='\\\\ ',
+                     asterisk='\\ast',
+                     prime='^\\prime',
+                     underscore='\\_')
+
+
+def _escape_token(m):
+    if m.lastgroup == 'symbol':
+        return '\\\\' + m.group('symbol')
+    return _REPLACEMENTS[m.lastgroup]
+
+
+class MarkdownCellTransformer(object):
+    '''convert lines of a markdown cell in a single pass
+
+    - `$$` lines are converted to ```math fences (esa.io only)
+    - characters in inline math are escaped
+    - image tags are replaced with fragments returned by `on_image(alttext, filename)`,
+      except images referred via url
+    '''
+
+    def __init__(self, dest):
+        self.dest = dest
+        self._re_inline_math = RE_INLINE_MATH_ESA if dest == 'esa' else RE_INLINE_MATH
+
+    def transform(self, lines, on_image=None):
+        '''generate fragments of markdown, str or returned by `on_image`
+        '''
+        count_ddollar = 0
+        is_display_math = False
+        for l in lines:
+            # マークダウン中の $$~$$ を ```math~``` にする
+            # esa.ioには必要だがgrowiには不要
+            if l == '$$\n' and self.dest == 'esa':
+                count_ddollar += 1
+                l = '```math\n' if count_ddollar % 2 == 1 else '```\n'
+
+            if l == '```math\n':
+                is_display_math = True
+            elif l == '```\n':
+                is_display_math = False
+            elif l == '$$\n':
+                is_display_math = not is_display_math
+            elif not is_display_math:
+                l = self.escape_inline_math(l)
+
+            if on_image is None or '![' not in l:
+                yield l
+            else:
+                yield from self._replace_images(l, on_image)
+
+    def escape_inline_math(self, l):
+        '''escape characters in inline math, which is odd-index string split by `$`
+        '''
+        if '$' not in l:
+            return l
+        lst = l.split('$')
+        for idx in range(1, len(lst), 2):
+            lst[idx] = self._re_inline_math.sub(_escape_token, lst[idx])
+        return '$'.join(lst)
+
+    def _replace_images(self, l, on_image):
+        pos = 0
+        for m in RE_IMAGE.finditer(l):
+            fn = m.group(2)
+            if len(fn) >= 4 and fn[:4] == 'http':
+                continue
+            if m.start() > pos:
+                yield l[pos:m.start()]
+            yield on_image(m.group(1), fn)
+            pos = m.end()
+        yield l[pos:]
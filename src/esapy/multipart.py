@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import uuid
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class MultipartEncoder(object):
+    '''multipart/form-data body which is read in chunks
+
+    This is a file-like object with known length, so it can be passed as `data`
+    of `requests` to stream a large file with `Content-Length` header.
+    The whole body is never built in memory.
+
+    Parameters
+    ----------
+    fields : list of (name, value)
+        form fields sent before the file
+    file : tuple (name, filename, fileobj, content_type)
+        fileobj has to be seekable
+    callback : callable(bytes_sent, total) or None
+        called each time a chunk has been read
+    throttle : callable(nbytes) or None
+        called before returning each chunk, which may block to limit bandwidth
+    '''
+
+    def __init__(self, fields, file, callback=None, throttle=None, boundary=None):
+        self.boundary = boundary if boundary is not None else uuid.uuid4().hex
+        self.callback = callback
+        self.throttle = throttle
+
+        # segments: bytes or (fileobj, start, size)
+        self._segments = []
+        for name, value in fields:
+            self._segments.append(self._part_header(name) + str(value).encode('utf-8') + b'\r\n')
+
+        name, filename, fileobj, content_type = file
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+        self._segments.append(self._part_header(name, filename, content_type))
+        self._segments.append((fileobj, start, size))
+        self._segments.append('\r\n--{:s}--\r\n'.format(self.boundary).encode('utf-8'))
+
+        self._length = sum(len(s) if isinstance(s, bytes) else s[2] for s in self._segments)
+        self._pos = 0
+
+    def _part_header(self, name, filename=None, content_type=None):
+        h = '--{:s}\r\nContent-Disposition: form-data; name="{:s}"'.format(self.boundary, name)
+        if filename is not None:
+            h += '; filename="{:s}"'.format(filename.replace('"', '%22'))
+        h += '\r\n'
+        if content_type is not None:
+            h += 'Content-Type: {:s}\r\n'.format(content_type)
+        return (h + '\r\n').encode('utf-8')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={:s}'.format(self.boundary)
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._length
+        self._pos = min(max(0, offset), self._length)
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._pos
+
+        buf = io.BytesIO()
+        offset = 0  # start of current segment in the body
+        for seg in self._segments:
+            seg_len = len(seg) if isinstance(seg, bytes) else seg[2]
+            if self._pos < offset + seg_len and buf.tell() < size:
+                i = self._pos - offset
+                n = min(seg_len - i, size - buf.tell())
+                if isinstance(seg, bytes):
+                    buf.write(seg[i:i + n])
+                else:
+                    fileobj, start, _ = seg
+                    fileobj.seek(start + i)
+                    buf.write(fileobj.read(n))
+                self._pos += n
+            offset += seg_len
+
+        if buf.tell() > 0:
+            if self.throttle is not None:
+                self.throttle(buf.tell())
+            if self.callback is not None:
+                self.callback(self._pos, self._length)
+        return buf.getvalue()
+
+
+def log_progress(name, step=0.25):
+    '''return a callback which logs progress of `name` every `step` of the total
+    '''
+    state = dict(next=step)
+
+    def callback(sent, total):
+        if total == 0 or sent / total < state['next']:
+            return
+        logger.info('  {:s}: {:d}/{:d} bytes sent ({:.0%})'.format(name, sent, total, sent / total))
+        while state['next'] <= sent / total:
+            state['next'] += step
+
+    return callback
@@ -5,22 +5,72 @@ import shutil
 import tempfile
 import re
 import os
+import random
 from urllib.parse import unquote
 import yaml
 import subprocess
 import base64
-import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 
 
 from . import api_esa, api_growi
 from .helper import get_version
+from .httpclient import DeadlineExceeded, DestinationUnavailable, NetworkError
+from .uploadcache import UploadCache, UploadJournal
+from .rendercache import RenderCache
+from .hashing import FileHasher, hash_bytes
+from .mdtransform import MarkdownCellTransformer, RE_IMAGE
 
 # logger
 from logging import getLogger, basicConfig, DEBUG, INFO
 logger = getLogger(__name__)
 
 
+IMAGE_TOKEN = '\x00esapy-image-{:d}\x00'  # placeholder of ImageRef in a staging file
+RE_IMAGE_TOKEN = re.compile('\x00esapy-image-(\\d+)\x00')
+
+
+def _render_chunk(proc, cells):
+    '''render cells in a worker process, returns serialized fragments of each cell
+    '''
+    return [proc._dump_fragments(list(proc._render_cell(cell)), cell) for cell in cells]
+
+
+class ImageRef(object):
+    '''placeholder of an image in intermediate markdown, which is rendered after uploading
+
+    Parameters
+    ----------
+    path_img : Path
+        file to be uploaded, or name of the content in memory at uploading
+    data : bytes or None
+        content of image in memory
+    templates : dict
+        key=status ('uploaded', 'deferred', 'failed'), value=format string of markdown
+        formatted with `url`, `b64` and `fields`
+    b64 : str or None
+        content of image in base64, which is decoded only when it is needed
+    '''
+
+    def __init__(self, path_img, data=None, templates=None, b64=None, **fields):
+        self.path_img = path_img
+        self.data = data
+        self.b64 = b64
+        self.templates = templates
+        self.fields = fields
+        self.h = self.url = self.status = None
+
+    def get_data(self):
+        if self.data is None and self.b64 is not None:
+            return base64.b64decode(self.b64)
+        return self.data
+
+    def render(self):
+        return self.templates[self.status].format(url=self.url, b64=self.b64, **self.fields)
+
+
 class EsapyProcessorBase(object):
     '''Base class
 
@@ -32,11 +82,16 @@ class EsapyProcessorBase(object):
     '''
 
     FILETYPE_SUFFIX = '.md'
+    JOURNAL = True  # finished uploads are journaled, since hashdict is read back from the input file
 
     def __init__(self, **kwargs):
         logger.info('Initializing processor={:s}'.format(self.__class__.__name__))
         self.args = dict(kwargs)
         self.result_preprocess = self.result_upload = self.post_info = None
+        # reported at the end of `esa up`, images are counted by references (an image referred twice counts 2)
+        self.summary = dict(images_uploaded=0, images_reused=0, images_deferred=0, images_failed=0,
+                            cells_reused=0, cells_rebuilt=0,
+                            publish='not published')
 
         self.path_input = Path(self.args['target']).resolve()  # target file
         logger.info('  input file={:s}'.format(str(self.path_input)))
@@ -51,6 +106,20 @@ class EsapyProcessorBase(object):
             raise RuntimeError('File type unmatched.')
 
     def __enter__(self):
+        # cache of uploaded files shared by all notebooks
+        self.upload_cache = None
+        if self.args['upload_cache'] is not None:
+            self.upload_cache = UploadCache(**self.args['upload_cache'])
+
+        # digests of local files are memoized by stat, and persisted in the upload cache
+        self.hasher = FileHasher(algorithm=self.args['hash_algorithm'],
+                                 image_hash=self.args['image_hash'],
+                                 store=self.upload_cache)
+
+        # finished uploads are journaled until hashdict is saved in the input file
+        cache_dir = (self.args['upload_cache'] or {}).get('cache_dir', None)
+        self.journal = UploadJournal(self.path_input if self.JOURNAL else None, cache_dir)
+
         logger.info('Securing temporal directory and files')
 
         # os file descriptor
@@ -73,6 +142,11 @@ class EsapyProcessorBase(object):
         for fd in self._fd_list:
             os.close(fd)
 
+        logger.info('file hashing: {:d} hits, {:d} misses'.format(self.hasher.hits, self.hasher.misses))
+        self.journal.close()
+        if self.upload_cache is not None:
+            self.upload_cache.close()
+
         if not self.args['leave_temp']:
             logger.info('Removing temporal working directory')
             shutil.rmtree(self.path_pwd)
@@ -116,6 +190,215 @@ class EsapyProcessorBase(object):
     def is_uploaded(self):
         return False
 
+    def _upload_binary(self, path_bin, h=None, data=None):
+        '''upload a file to the destination
+
+        If the content hash `h` is given, the upload cache shared by all notebooks
+        is looked up before uploading, and the new url is recorded.
+        If `data` (bytes) is given, it is uploaded from memory and `path_bin` is used as its name.
+
+        Return: (url, True if it is found in the upload cache)
+        '''
+        dest = self.args['dest']
+        base = self._get_base()
+
+        if h is not None and self.upload_cache is not None:
+            url = self.upload_cache.get(dest, base, h)
+            if url is not None and len(self._find_dead_urls({h: url})) > 0:
+                url = None
+            if url is not None:
+                logger.info('{:s} has been uploaded before, url={:s}'.format(str(path_bin), url))
+                return url, True
+
+        if dest == 'esa':
+            url, _ = api_esa.upload_binary(path_bin,
+                                           token=self.args['token'],
+                                           team=self.args['team'],
+                                           proxy=self.args['proxy'],
+                                           data=data)
+        elif dest == 'growi':
+            url, _ = api_growi.upload_binary(path_bin,
+                                             token=self.args['token'],
+                                             url=self.args['url'],
+                                             proxy=self.args['proxy'],
+                                             data=data)
+        else:
+            raise RuntimeError('invalid dest.')
+
+        if h is not None and self.upload_cache is not None:
+            size = len(data) if data is not None else Path(path_bin).stat().st_size
+            self.upload_cache.put(dest, base, h, url, size=size)
+        return url, False
+
+    def _upload_images(self, refs, hashdict):
+        '''upload images of `refs` (list of ImageRef) and set their url and status
+
+        Images already in `hashdict` (key=hash, value=url) are not uploaded. Others are
+        uploaded on a pool of `upload_workers` threads, each content only once, and recorded in hashdict.
+        Images which are not uploaded because of an outage or the deadline are left for the next run.
+        '''
+        pending = {}  # key=hash, value=list of ImageRef
+        hashed = []
+        for r in refs:
+            try:
+                r.h = self._get_image_hash(r.path_img, r.get_data())
+                hashed.append(r)
+            except OSError as e:
+                logger.warning('  Reading image failed, {:}'.format(e))
+                r.status = 'failed'
+                self.summary['images_failed'] += 1
+
+        # urls which are removed on the server are uploaded again
+        for h in self._find_dead_urls({r.h: hashdict[r.h] for r in hashed if r.h in hashdict}):
+            del hashdict[h]
+
+        for r in hashed:
+            if r.h in hashdict:
+                r.url, r.status = hashdict[r.h], 'uploaded'
+                self.summary['images_reused'] += 1
+            else:
+                pending.setdefault(r.h, []).append(r)
+        if len(pending) == 0:
+            return
+        logger.info('Uploading {:d} images ({:d} references)...'.format(len(pending), sum(len(v) for v in pending.values())))
+
+        with ThreadPoolExecutor(max_workers=self.args['upload_workers']) as ex:
+            # デコードはワーカー内で行い，同時に展開する画像を upload_workers 個までに抑える
+            futures = {ex.submit(lambda r=v[0], h=h: self._upload_binary(r.path_img, h, r.get_data())): h
+                       for h, v in pending.items()}
+            for f in as_completed(futures):
+                h = futures[f]
+                url, is_cached = None, False
+                try:
+                    url, is_cached = f.result()
+                    hashdict[h] = url
+                    status = 'uploaded'
+                    self.journal.append(self.args['dest'], self._get_base(), h, url)
+                except DeadlineExceeded as e:
+                    if self.result_preprocess:
+                        logger.warning('{:} -> remaining uploads are deferred.'.format(e))
+                    self.result_preprocess = False
+                    status = 'deferred'
+                except DestinationUnavailable:
+                    self._defer_upload()
+                    status = 'deferred'
+                except RuntimeError as e:
+                    logger.warning(e)
+                    status = 'failed'
+                for r in pending[h]:
+                    r.url, r.status = url, status
+                key = 'images_reused' if status == 'uploaded' and is_cached else 'images_' + status
+                self.summary[key] += len(pending[h])
+
+    def _find_dead_urls(self, urls):
+        '''check a sample of uploaded urls with HEAD requests (--validate-urls)
+
+        Urls checked within the TTL of the upload cache are skipped.
+        Dead urls are removed from the upload cache, and their hashes are returned.
+
+        Parameters
+        ----------
+        urls : dict, key=hash, value=url
+        '''
+        ratio = self.args['validate_urls']
+        if ratio is None or len(urls) == 0:
+            return set()
+        items = [(h, u) for h, u in urls.items()
+                 if (self.upload_cache is None or self.upload_cache.needs_check(u)) and random.random() < ratio]
+        if len(items) == 0:
+            return set()
+
+        logger.info('Checking {:d} urls of uploaded images...'.format(len(items)))
+        if self.args['dest'] == 'esa':
+            def is_alive(u):
+                return api_esa.is_alive(u, token=self.args['token'], team=self.args['team'], proxy=self.args['proxy'])
+        else:
+            def is_alive(u):
+                return api_growi.is_alive(u, token=self.args['token'], url=self.args['url'], proxy=self.args['proxy'])
+        if len(items) == 1:
+            res = [is_alive(items[0][1])]
+        else:
+            with ThreadPoolExecutor(max_workers=self.args['upload_workers']) as ex:
+                res = list(ex.map(is_alive, [u for _, u in items]))
+
+        dead = set()
+        for (h, u), alive in zip(items, res):
+            if alive is None:  # unknown, checked again next time
+                continue
+            if alive:
+                if self.upload_cache is not None:
+                    self.upload_cache.record_check(u)
+                continue
+            logger.warning('  {:s} has been removed. -> uploading again'.format(u))
+            dead.add(h)
+            if self.upload_cache is not None:
+                self.upload_cache.invalidate(self.args['dest'], self._get_base(), h)
+        return dead
+
+    def _replay_journal(self, hashdict):
+        '''add uploads finished in an interrupted run to hashdict
+        '''
+        n = 0
+        for h, url in self.journal.replay(self.args['dest'], self._get_base()).items():
+            if h not in hashdict:
+                hashdict[h] = url
+                n += 1
+        if n > 0:
+            logger.info('{:d} uploads of a previous run are resumed from journal.'.format(n))
+
+    def _get_base(self):
+        '''team name (esa.io) or url (growi)
+        '''
+        return self.args['team'] if self.args['dest'] == 'esa' else self.args['url']
+
+    def _defer_upload(self):
+        '''mark that an image was not uploaded because the destination is down
+
+        The image is not recorded in hashdict, so it is uploaded at the next run.
+        '''
+        if self.result_preprocess:
+            logger.warning('Destination is unavailable. -> uploading images is deferred.')
+        self.result_preprocess = False
+
+    def _get_publish_digest(self, md_body, info_dict):
+        '''digest of the rendered body and attributes of the post, to detect a publish which changes nothing
+        '''
+        d = dict(body=md_body,
+                 dest=self.args['dest'],
+                 name=info_dict.get('name', None),
+                 tags=sorted(info_dict.get('tags', None) or []),
+                 category=info_dict.get('category', None),
+                 wip=info_dict.get('wip', None))
+        s = json.dumps(d, ensure_ascii=False, sort_keys=True)
+        return hash_bytes(s.encode('utf-8'), self.args['hash_algorithm'])
+
+    def _get_image_hash(self, path_img=None, data=None):
+        '''key of an image file, or of image `data` (bytes) in memory, in hashdict and upload cache
+
+        image_hash=bytes: sha256 (or blake2b with --hash-algorithm) of the file
+        image_hash=pixels: fingerprint of PNG content (see `png_fingerprint`), which is
+          unchanged when the same figure is rendered again. Other files fall back to the hash of bytes.
+        '''
+        if data is None:
+            return self.hasher.hash(path_img)
+        return self.hasher.hash_data(data)
+
+    def _prefetch_image_hashes(self, lines):
+        '''hash local image files referred in `lines` on a thread pool
+
+        The digests are memoized, so hashing in the main loop does not read the files again.
+        '''
+        paths = []
+        for l in lines:
+            for m in RE_IMAGE.finditer(l):
+                fn = m.group(2)
+                if fn[:4] == 'http' or fn.startswith('attachment:'):
+                    continue
+                paths.append((self.path_root / Path(unquote(fn))).resolve())
+        if len(paths) > 0:
+            logger.info('Hashing {:d} image files...'.format(len(paths)))
+            self.hasher.hash_files(paths)
+
     def gather_post_info(self):
         '''gathering informatin for create/update post
 
@@ -133,9 +416,15 @@ class EsapyProcessorBase(object):
 class MarkdownProcessor(EsapyProcessorBase):
     FILETYPE_SUFFIX = '.md'
 
+    # failed images are left as they are
+    TEMPLATES_IMAGE = dict(uploaded='![{alt}]({url})',
+                           deferred='{orig}',
+                           failed='{orig}')
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.input_yaml_frontmatter = None
+        self.hashdict = {}  # key=hash, value=url, saved in YAML frontmatter
 
     def __enter__(self):
         super().__enter__()
@@ -169,6 +458,7 @@ class MarkdownProcessor(EsapyProcessorBase):
                         break
                 yf = md_body[1:ind_start_body]  # frontmatter without '---'
                 self.input_yaml_frontmatter = yaml.safe_load(''.join(yf))
+                self.hashdict = dict((self.input_yaml_frontmatter or {}).get('hashdict', None) or {})
                 logger.info('YAML frontmatter is detected in input file.')
                 logger.debug(self.input_yaml_frontmatter)
             else:
@@ -181,15 +471,22 @@ class MarkdownProcessor(EsapyProcessorBase):
             logger.info('Original markdown body excluded YAML frontmatter has been saved.')
 
             # process each line
+            self._replay_journal(self.hashdict)
+            self._prefetch_image_hashes(md_body[ind_start_body + 1:])
             for i, l in enumerate(md_body[ind_start_body + 1:]):
-                _l, _res = self._replace_line(i, l)
-                md_body_modified.append(_l)
-                res.extend(_res)
+                md_body_modified.extend(self._replace_line(i, l))
+
+        # upload images which are not in hashdict, and fill urls
+        self.result_preprocess = True
+        refs = [f for f in md_body_modified if isinstance(f, ImageRef)]
+        self._upload_images(refs, self.hashdict)
+        md_body_modified = [f.render() if isinstance(f, ImageRef) else f for f in md_body_modified]
+        res = [(r.fields['line'], str(r.path_img), r.status) for r in refs]
 
         logger.info('Replacing finished.')
         logger.debug(res)
-        count_images = len([r for r in res if r[2] != 'http'])  # images which should be uploaded
-        count_success = [r[2] for r in res].count('upload scceeded')  # images which are uploaded successfully
+        count_images = len(refs)  # images which should be uploaded
+        count_success = [r[2] for r in res].count('uploaded')  # images which are uploaded successfully
         logger.info('  {:d} image tags to be uploaded are detected.'.format(count_images))
         logger.info('  {:d} images are uploaded successfully.'.format(count_success))
         self.result_preprocess = (count_images == count_success)  # Are all uploadings succeeded ?
@@ -203,11 +500,11 @@ class MarkdownProcessor(EsapyProcessorBase):
 
     def _replace_line(self, i, l):
         '''process single line
-        '''
-        res = []  # line, path,
 
+        Return: list of fragments, str or ImageRef of local image
+        '''
         # find image tags
-        matches = list(re.finditer(r'!\[(.*?)\]\((.+?)\)', l))
+        matches = list(RE_IMAGE.finditer(l))
         if len(matches) > 1:
             logger.info('#{:d} line, {:d} image tags are found.'.format(i, len(matches)))
             logger.debug(l.strip())
@@ -216,47 +513,29 @@ class MarkdownProcessor(EsapyProcessorBase):
             logger.debug(l.strip())
         else:
             # logger.debug('#{:d} line, no image is detected.'.format(i))
-            return l, res
+            return [l]
 
-        # upload & replace
-        _l = l
-        res = []
-        for m in matches[::-1]:  # 後ろから処理すると前にあるものはインデックスが変化しないので逆順に並べる
+        # replace local images with ImageRef, which are uploaded later
+        fragments = []
+        pos = 0
+        for m in matches:
             # path を抽出
             alttext, fn_img = m.group(1), m.group(2)
             if len(fn_img) > 4 and fn_img[:4] == 'http':
                 logger.info('  This image is referred via url={:s}'.format(fn_img))
-                res.append((i, fn_img, 'http'))
                 continue
-            logger.info('  uploading, filepath={:s}'.format(fn_img))
+            logger.info('  local image, filepath={:s}'.format(fn_img))
             path_img = self.path_root / Path(unquote(fn_img))
             path_img = path_img.resolve()
 
-            # パス解決できるか確認
-            if not path_img.exists():
-                logger.warn('  File not found, {:s}'.format(str(path_img)))
-                res.append((i, str(path_img), 'file not found'))
-                continue
+            if m.start() > pos:
+                fragments.append(l[pos:m.start()])
+            fragments.append(ImageRef(path_img, None, self.TEMPLATES_IMAGE,
+                                      alt=alttext, orig=m.group(0), line=i))
+            pos = m.end()
+        fragments.append(l[pos:])
 
-            # upload image
-            try:
-                url, _ = upload_binary(path_img,
-                                       token=self.args['token'],
-                                       team=self.args['team'],
-                                       proxy=self.args['proxy'])
-
-            except Exception as e:
-                logger.warning(e)
-                res.append((i, str(path_img), 'upload failed'))
-
-            else:  # upload succeeded.
-                # replace file path with URL
-                _l = _l[:m.start()] \
-                    + '![%s](%s)' % (alttext, url) \
-                    + _l[m.end():]
-                res.append((i, str(path_img), 'upload scceeded'))
-
-        return _l, res
+        return fragments
 
     def upload_body(self):
         logger.info('Uploading markdown body ...')
@@ -271,26 +550,28 @@ class MarkdownProcessor(EsapyProcessorBase):
         post_number = self.get_post_number()
         if post_number is None or self.args['post_mode'] == 'new':
             logger.info('This file has not been uploaded before. ==> create new post')
-            post_url, res = create_post(md_body,
-                                        name=info_dict['name'],
-                                        tags=info_dict['tags'],
-                                        category=info_dict['category'],
-                                        wip=info_dict['wip'],
-                                        message=info_dict['message'],
-                                        token=self.args['token'],
-                                        team=self.args['team'],
-                                        proxy=self.args['proxy'])
+            post_url, res = api_esa.create_post(md_body,
+                                                name=info_dict['name'],
+                                                tags=info_dict['tags'],
+                                                category=info_dict['category'],
+                                                wip=info_dict['wip'],
+                                                message=info_dict['message'],
+                                                token=self.args['token'],
+                                                team=self.args['team'],
+                                                proxy=self.args['proxy'])
+            self.summary['publish'] = 'created'
         else:
             logger.info('This file has been already uploaded. ==> patch the post')
-            post_url, res = patch_post(post_number, md_body,
-                                       name=info_dict['name'],
-                                       tags=info_dict['tags'],
-                                       category=info_dict['category'],
-                                       wip=info_dict['wip'],
-                                       message=info_dict['message'],
-                                       token=self.args['token'],
-                                       team=self.args['team'],
-                                       proxy=self.args['proxy'])
+            post_url, res = api_esa.patch_post(post_number, md_body,
+                                               name=info_dict['name'],
+                                               tags=info_dict['tags'],
+                                               category=info_dict['category'],
+                                               wip=info_dict['wip'],
+                                               message=info_dict['message'],
+                                               token=self.args['token'],
+                                               team=self.args['team'],
+                                               proxy=self.args['proxy'])
+            self.summary['publish'] = 'updated'
 
         self.post_info = res.json()
 
@@ -315,6 +596,8 @@ class MarkdownProcessor(EsapyProcessorBase):
             logger.info('output file path={:s}'.format(str(p)))
             with p.open('w', encoding='utf-8') as f:
                 f.writelines(md_body)
+            if self.post_info is not None:  # hashdict is saved in frontmatter
+                self.journal.clear()
 
         elif self.args['destructive']:
             if self.result_upload:
@@ -322,11 +605,14 @@ class MarkdownProcessor(EsapyProcessorBase):
                 logger.info('output file path is input file path={:s}'.format(str(p)))
                 with p.open('w', encoding='utf-8') as f:
                     f.writelines(md_body)
+                if self.post_info is not None:  # hashdict is saved in frontmatter
+                    self.journal.clear()
             else:
                 logger.info('uploading body was failed, so saving is skipped.')
 
         else:
             logger.info('no-output mode')
+            self.journal.clear()  # uploads are reused via the upload cache
 
     def _get_yaml_frontmatter(self):
         '''get yaml frontmatter for save derived from HTTP_RESPONSE
@@ -342,7 +628,11 @@ class MarkdownProcessor(EsapyProcessorBase):
               'updated_at: {:s}'.format(self.post_info['updated_at']),
               'published: {:s}'.format(str(not self.post_info['wip']).lower()),
               'number: {:s}'.format(str(self.post_info['number'])),
-              '---\n']
+              ]
+        if len(self.hashdict) > 0:
+            # urls of uploaded images, key=hash
+            yf.append(yaml.safe_dump(dict(hashdict=self.hashdict), default_flow_style=False).rstrip('\n'))
+        yf.append('---\n')
         yf = '\n'.join(yf)
         return yf
 
@@ -407,6 +697,7 @@ class TexProcessor(MarkdownProcessor):
     '''
 
     FILETYPE_SUFFIX = '.tex'
+    JOURNAL = False  # hashdict is not read back from tex
 
     def is_uploaded(self):
         return False
@@ -459,6 +750,7 @@ class IpynbProcessor_via_nbconvert(MarkdownProcessor):
     '''
 
     FILETYPE_SUFFIX = '.ipynb'
+    JOURNAL = False  # hashdict is not read back from the notebook
 
     def is_uploaded(self):
         return False
@@ -513,9 +805,19 @@ class IpynbProcessor(EsapyProcessorBase):
     FILETYPE_SUFFIX = '.ipynb'
     SCROLL_HEIGHT = 200
 
+    # markdown of images for each result of uploading
+    TEMPLATES_MD_IMAGE = dict(uploaded='![{alt}]({url})',
+                              deferred='![{alt} (upload deferred)]({fn})',
+                              failed='![{alt} (upload failed)]({fn})')
+    # inlining is not a fallback for an outage, because it makes the body huge
+    TEMPLATES_OUTPUT_IMAGE = dict(uploaded='![{alt}]({url})\n',
+                                  deferred='![{alt} (upload deferred)](error.png)\n',
+                                  failed='<img src="data:image/png;base64,{b64}">\n')
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.nbjson = None
+        self.md_transformer = MarkdownCellTransformer(self.args['dest'])
 
     def __enter__(self):
         super().__enter__()
@@ -526,8 +828,18 @@ class IpynbProcessor(EsapyProcessorBase):
         self.path_ipynb = Path(self.path_ipynb)
         logger.info('  intermediate ipynb file={:s}'.format(str(self.path_ipynb)))
 
+        # rendered cells shared by all notebooks
+        self.render_cache = None
+        if self.args.get('render_cache', None) is not None:
+            self.render_cache = RenderCache(**self.args['render_cache'])
+
         return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.render_cache is not None:
+            self.render_cache.close()
+        super().__exit__(exc_type, exc_value, traceback)
+
     def preprocess(self):
         # load ipynb
         with self.path_input.open('r', encoding='utf-8') as f:
@@ -557,44 +869,188 @@ class IpynbProcessor(EsapyProcessorBase):
         if 'hashdict' not in self.nbjson['metadata']['esapy']:
             self.nbjson['metadata']['esapy']['hashdict'] = {}  # key=sha256, value=url
             logger.debug('Notebook hash_dict initialized.')
+        self._replay_journal(self.nbjson['metadata']['esapy']['hashdict'])
+        if self.args['dest'] == 'growi':
+            api_growi.load_upload_page(self.nbjson['metadata']['esapy'].get('growi_upload_page', None),
+                                       token=self.args['token'],
+                                       url=self.args['url'],
+                                       proxy=self.args['proxy'])
 
         # Process each cell
         logger.info('Processing {:d} cells...'.format(len(self.nbjson['cells'])))
-        md_body = []
-        for cell in self.nbjson['cells']:
-            proc_func = {'raw': self._process_cell_raw,
-                         'markdown': self._process_cell_md,
-                         'code': self._process_cell_code}[cell['cell_type']]
-            md_body.extend(proc_func(cell))
+        self.result_preprocess = True  # TODO
+        self._prefetch_image_hashes([l for cell in self.nbjson['cells'] if cell['cell_type'] == 'markdown'
+                                     for l in cell['source']])
 
         # save temprorary files
-        with self.path_md.open('w', encoding='utf-8') as f:
-            f.writelines(md_body)
+        self._write_markdown(self._render_cells(), self.nbjson['metadata']['esapy']['hashdict'])
         logger.info('Intermediate md file has been saved.')
-        with self.path_ipynb.open('w', encoding='utf-8') as f:
-            json.dump(self.nbjson, f, ensure_ascii=False, indent=4, sort_keys=True, separators=(',', ': '))
-            logger.info('Intermediate ipynb file has been saved.')
+        self._save_intermediate_ipynb()
 
-        self.result_preprocess = True  # TODO
         return self.result_preprocess
 
-    def _process_cell_raw(self, cell_raw):
-        md = ['\n', '```\n']
-        md.extend(list(cell_raw['source']))
-        md[-1] = md[-1] + '\n'
-        md.extend(['```\n', '\n'])
+    def _render_cells(self):
+        '''generate fragments of markdown (str or ImageRef) cell by cell
+
+        Cells found in the render cache are not rendered again.
+        Others are rendered on a process pool when `jobs` > 1 and they are large enough.
+        '''
+        cells = self.nbjson['cells']
+
+        # rendering depends on the version of esapy and the notebook, besides the cell itself
+        digests = [None] * len(cells)
+        values = [None] * len(cells)  # serialized fragments
+        if self.render_cache is not None:
+            salt = dict(version=get_version(), language=self.language, root=str(self.path_root),
+                        folding_mode=self.args['folding_mode'], dest=self.args['dest'])
+            for i, cell in enumerate(cells):
+                s = json.dumps(dict(salt, cell=cell), ensure_ascii=False, sort_keys=True)
+                digests[i] = hash_bytes(s.encode('utf-8'))
+                values[i] = self.render_cache.get(digests[i])
+
+        pending = [cell for cell, value in zip(cells, values) if value is None]
+        rendered = self._render_cells_on_pool(pending) if self._is_parallel(pending) else None
+
+        for cell, digest, value in zip(cells, digests, values):
+            if value is not None:
+                self.summary['cells_reused'] += 1
+                yield from self._load_fragments(value, cell)
+                continue
 
+            self.summary['cells_rebuilt'] += 1
+            value = next(rendered) if rendered is not None else None
+            if value is not None:
+                fragments = self._load_fragments(value, cell)
+            else:
+                fragments = list(self._render_cell(cell))
+                if digest is not None:
+                    value = self._dump_fragments(fragments, cell)
+            if digest is not None and value is not None:
+                self.render_cache.put(digest, value)
+            yield from fragments
+
+    def _render_cell(self, cell):
+        proc_func = {'raw': self._process_cell_raw,
+                     'markdown': self._process_cell_md,
+                     'code': self._process_cell_code}[cell['cell_type']]
+        return proc_func(cell)
+
+    def _is_parallel(self, cells):
+        '''whether cells are rendered on a process pool, judged by the size of their text
+        '''
+        if self.args.get('jobs', 1) <= 1 or len(cells) < 2:
+            return False
+        size = 0
+        for cell in cells:
+            size += sum(len(l) for l in cell['source'])
+            for o in cell.get('outputs', []):
+                size += sum(len(l) for l in o.get('text', []))
+                size += sum(len(l) for k, v in o.get('data', {}).items() if k != 'image/png' for l in v)
+        logger.debug('  size of cells to be rendered={:d}'.format(size))
+        return size >= self.args['parallel_threshold']
+
+    def _render_cells_on_pool(self, cells):
+        '''render cells on worker processes in ordered chunks, and generate serialized fragments in cell order
+
+        Images are not uploaded in workers; ImageRef are returned to this process.
+        '''
+        jobs = self.args['jobs']
+        chunksize = -(-len(cells) // (jobs * 4))
+        chunks = [cells[i:i + chunksize] for i in range(0, len(cells), chunksize)]
+        logger.info('Rendering {:d} cells on {:d} processes...'.format(len(cells), jobs))
+        # spawn: sqlite connections and threads of this process are not inherited
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for values in pool.map(_render_chunk, [self] * len(chunks), chunks):
+                yield from values
+
+    def __getstate__(self):
+        '''attributes required to render cells, which are sent to worker processes
+        '''
+        return dict(args=self.args, language=self.language, path_root=self.path_root,
+                    md_transformer=self.md_transformer)
+
+    def _get_cell_b64s(self, cell):
+        '''base64 images in a cell, which ImageRef of cached fragments refer by index
+        '''
+        b64s = [o['data']['image/png'] for o in cell.get('outputs', []) if 'image/png' in o.get('data', {})]
+        for at in cell.get('attachments', {}).values():
+            b64s.extend(at.values())
+        return b64s
+
+    def _dump_fragments(self, fragments, cell):
+        '''serialize rendered fragments of a cell into JSON, or None if they cannot be
+        '''
+        b64s = self._get_cell_b64s(cell)
+        items = []
+        for f in fragments:
+            if isinstance(f, ImageRef):
+                if f.data is not None:
+                    return None
+                items.append(dict(path_img=str(f.path_img), templates=f.templates, fields=f.fields,
+                                  b64=None if f.b64 is None else b64s.index(f.b64)))
+            elif len(items) > 0 and isinstance(items[-1], str):
+                items[-1] += f
+            else:
+                items.append(f)
+        return json.dumps(items, ensure_ascii=False)
+
+    def _load_fragments(self, value, cell):
+        b64s = self._get_cell_b64s(cell)
+        for item in json.loads(value):
+            if isinstance(item, str):
+                yield item
+            else:
+                yield ImageRef(Path(item['path_img']), None, item['templates'],
+                               b64=None if item['b64'] is None else b64s[item['b64']], **item['fields'])
+
+    def _write_markdown(self, fragments, hashdict):
+        '''write fragments to the intermediate markdown file
+
+        Fragments are streamed to a staging file, where images are written as tokens.
+        After images are uploaded, tokens are replaced with their markdown line by line.
+        '''
+        path_stage = self.path_pwd / 'stage.md'
+        refs = []
+        with path_stage.open('w', encoding='utf-8', newline='') as f:
+            for frag in fragments:
+                if isinstance(frag, ImageRef):
+                    f.write(IMAGE_TOKEN.format(len(refs)))
+                    refs.append(frag)
+                else:
+                    f.write(frag)
+
+        # upload images collected from all cells, and fill urls
+        self._upload_images(refs, hashdict)
+        with path_stage.open('r', encoding='utf-8', newline='') as f_stage, \
+                self.path_md.open('w', encoding='utf-8') as f:
+            for l in f_stage:
+                f.write(RE_IMAGE_TOKEN.sub(lambda m: refs[int(m.group(1))].render(), l))
+        path_stage.unlink()
+
+    def _fence_lines(self, head, lines):
+        '''head and lines, where a line break is appended to the last one
+        '''
+        lines = list(lines)
+        if len(lines) == 0:
+            yield head + '\n'
+            return
+        yield head
+        yield from lines[:-1]
+        yield lines[-1] + '\n'
+
+    def _process_cell_raw(self, cell_raw):
         # folding
         is_source_hidden = cell_raw.get('metadata', {}).get('jupyter', {}).get('source_hidden', False)
         is_source_hidden = is_source_hidden and (self.args['folding_mode'] != 'ignore')
         if is_source_hidden:
-            md = ['\n',
-                  '<details>\n',
-                  '<summary>hidden raw cell</summary>\n', '\n',
-                  *md,
-                  '\n', '</details>\n', '\n']
+            yield from ('\n', '<details>\n', '<summary>hidden raw cell</summary>\n', '\n')
+
+        yield '\n'
+        yield from self._fence_lines('```\n', cell_raw['source'])
+        yield from ('```\n', '\n')
 
-        return md
+        if is_source_hidden:
+            yield from ('\n', '</details>\n', '\n')
 
     def _process_cell_md(self, cell_md):
         md = ['\n']
@@ -602,255 +1058,192 @@ class IpynbProcessor(EsapyProcessorBase):
         md[-1] = md[-1] + '\n'
         md.extend(['\n'])
 
-        # マークダウン中の $$~$$ を ```math~``` にする
-        # esa.ioには必要だがgrowiには不要
-        if self.args['dest'] == 'esa':
-            count_ddoller = 0
-            for i in range(len(md)):
-                if md[i] != '$$\n':
-                    continue
-
-                count_ddoller += 1
+        # 画像は ImageRef に置き換え、アップロード後にurlを埋める
+        attachments = cell_md.get('attachments', {})
 
-                if count_ddoller % 2 == 1:
-                    md[i] = '```math\n'
-                else:
-                    md[i] = '```\n'
-
-        # マークダウン中の inline math を `\` でエスケープ
-        is_display_math = False
-        for i in range(len(md)):
-            if md[i] == '```math\n':
-                is_display_math = True
-            elif md[i] == '```\n':
-                is_display_math = False
-            elif md[i] == '$$\n':
-                is_display_math = not is_display_math
+        def on_image(alttxt, fn):
+            # attachment は参照されているものだけをメモリ上でデコードする
+            at_name = fn[len('attachment:'):] if fn.startswith('attachment:') else None
+            if at_name in attachments:
+                path_img, img64 = Path(at_name), list(attachments[at_name].values())[0]
             else:
-                if is_display_math:
-                    continue
-
-                # find characters to be escaped
-                lst = md[i].split('$')  # odd-index sring is inline math
-                for j in range(len(lst) // 2):
-                    idx = 2 * j + 1
-                    lst[idx] = re.sub(r'\\\\', r'\\\\\\\\', lst[idx])  # '\\' -> '\\\\' (escaping line break)
-                    lst[idx] = re.sub(r'(?<!\\)\\\s', r'\\\\ ', lst[idx])  # '\ ' -> '\\ ' (escaping hspace)
-                    for c in ('_', ',', '!', '#', '%', '&', '{', '}'):  # '\%' -> '\\%' など
-                        lst[idx] = re.sub(r'(?<!\\)\\{:s}'.format(c), r'\\\\{:s}'.format(c), lst[idx])
-                    lst[idx] = re.sub(r'\*', r'\\ast', lst[idx])  # '*'   -> '\ast'
-                    lst[idx] = re.sub(r"(?<!\^)'", r'^\\prime', lst[idx])  # "'"   -> '^\prime'
-                    if self.args['dest'] == 'esa':
-                        lst[idx] = re.sub(r'(?<!\\)_', '\\_', lst[idx])  # 'a_i' -> 'a\_i'
-
-                md[i] = '$'.join(lst)
-
-        # attachment があったら抽出
-        at_images = {}  # key=attachment:(xxx.png), value=file path
-        for at_name, v in cell_md.get('attachments', {}).items():
-            img64 = list(v.values())[0]
-            path_at = self._save_encodedimage(img64)
-            at_images[at_name] = path_at
-
-        # attachment image を参照するimgタグがあったら抽出後のファイルパスで置き換え
-        for i, l in enumerate(md):
-            _l = l
-            matches = list(re.finditer(r'!\[(.*?)\]\(attachment:(.+?)\)', l))
-            for m in matches[::-1]:
-                path_img = at_images.get(m.group(2), m.group(2))
-                _l = _l[:m.start()] \
-                    + '![%s](%s)' % (m.group(1), str(path_img)) \
-                    + _l[m.end():]
-            md[i] = _l
-
-        # imgタグがあったらsha256からurlをゲットして、置き換え
-        # Note: ファイル名にカッコ()が入っていると正規表現に失敗する。
-        # TODO: regexパッケージを使えば入れ子のマッチ対処できるらしい
-        for i, l in enumerate(md):
-            _l = l
-            matches = list(re.finditer(r'!\[(.*?)\]\((.+?)\)', l))
-            for m in matches[::-1]:
-                fn = m.group(2)
-                if len(fn) >= 4 and fn[:4] == 'http':
-                    continue
-
-                alttxt = m.group(1)
-                path_img = self.path_root / Path(unquote(fn))
-                try:
-                    url = self._upload_image_and_get_url(path_img)
-                except RuntimeError:
-                    url = unquote(fn)
-                    alttxt = alttxt + ' (upload failed)'
-
-                _l = _l[:m.start()] \
-                    + '![%s](%s)' % (alttxt, url) \
-                    + _l[m.end():]
-            md[i] = _l
+                path_img, img64 = self.path_root / Path(unquote(fn if at_name is None else at_name)), None
+            return ImageRef(path_img, None, self.TEMPLATES_MD_IMAGE, b64=img64, alt=alttxt, fn=unquote(fn))
 
         # folding
         is_source_hidden = cell_md.get('metadata', {}).get('jupyter', {}).get('source_hidden', False)
         is_source_hidden = is_source_hidden and (self.args['folding_mode'] != 'ignore')
         if is_source_hidden:
-            md = ['\n',
-                  '<details>\n',
-                  '<summary>hidden markdown cell</summary>\n',
-                  '\n',
-                  *md,
-                  '\n', '</details>\n', '\n']
-        return md
+            yield from ('\n', '<details>\n', '<summary>hidden markdown cell</summary>\n', '\n')
+        # math and images are converted in a single pass
+        yield from self.md_transformer.transform(md, on_image)
+        if is_source_hidden:
+            yield from ('\n', '</details>\n', '\n')
 
     def _process_cell_code(self, cell_code):
-        md_source = ['\n', '```{:s}\n'.format(self.language)]
-        md_source.extend(list(cell_code['source']))
-        md_source[-1] = md_source[-1] + '\n'
-        md_source.extend(['```\n', '\n'])
-
-        # source folding
-        is_source_hidden = cell_code.get('metadata', {}).get('jupyter', {}).get('source_hidden', False)
-        is_esapy_folded = any([self._includes_magic(l) for l in md_source])
-        is_open = (self.args['folding_mode'] == 'ignore') \
-            or not ((self.args['folding_mode'] == 'auto' and is_esapy_folded) or is_source_hidden)
-
         execution_count = cell_code.get('execution_count', 0)
         execution_count = execution_count if execution_count is not None else 0
 
-        summary = 'code source (with %esapy_fold)' if is_esapy_folded else 'code source'
+        # source
+        if len(cell_code['source']) > 0:
+            # source folding
+            is_source_hidden = cell_code.get('metadata', {}).get('jupyter', {}).get('source_hidden', False)
+            is_esapy_folded = any([self._includes_magic(l) for l in cell_code['source']])
+            is_open = (self.args['folding_mode'] == 'ignore') \
+                or not ((self.args['folding_mode'] == 'auto' and is_esapy_folded) or is_source_hidden)
+
+            summary = 'code source (with %esapy_fold)' if is_esapy_folded else 'code source'
 
-        md_source = ['\n',
-                     '<details open>\n' if is_open else '<details>\n',
-                     '<summary>[{:d}]: {:s}</summary>\n'.format(execution_count, summary),
-                     '\n', *md_source, '\n', '</details>\n', '\n']
+            yield from ('\n',
+                        '<details open>\n' if is_open else '<details>\n',
+                        '<summary>[{:d}]: {:s}</summary>\n'.format(execution_count, summary),
+                        '\n', '\n')
+            yield from self._fence_lines('```{:s}\n'.format(self.language), cell_code['source'])
+            yield from ('```\n', '\n', '\n', '</details>\n', '\n')
 
         # outputs
+        if len(cell_code['outputs']) == 0:
+            return
         func_dict = dict(stream=self._process_output_stream,
                          execute_result=self._process_output_result,
                          display_data=self._process_output_disp,
                          error=self._process_output_error)
-        md_output = []
-        for b in cell_code['outputs']:
-            func = func_dict[b['output_type']]
-            md_output.extend(func(b))
+
+        # output folding
+        is_outputs_hidden = cell_code.get('metadata', {}).get('jupyter', {}).get('outputs_hidden', False)
+        is_open = (self.args['folding_mode'] == 'ignore') or (not is_outputs_hidden)
+        yield from ('\n',
+                    '<details open>\n' if is_open else '<details>\n',
+                    '<summary>[{:d}]: outputs</summary>\n'.format(execution_count),
+                    '\n')
 
         # output scrolling
         is_scrolled = cell_code.get('metadata', {}).get('scrolled', False)
-        if len(cell_code['outputs']) > 0 and is_scrolled:
-            md_output.insert(0, '\n\n<div style="overflow: scroll; height: {:d}pt;">\n\n'.format(self.SCROLL_HEIGHT))
-            md_output.append('\n\n</div>\n\n')
+        if is_scrolled:
+            yield '\n\n<div style="overflow: scroll; height: {:d}pt;">\n\n'.format(self.SCROLL_HEIGHT)
+        for b in self._merge_streams(cell_code['outputs']):
+            yield from func_dict[b['output_type']](b)
+        if is_scrolled:
+            yield '\n\n</div>\n\n'
 
-        # output folding
-        if len(cell_code['outputs']) > 0:
-            is_outputs_hidden = cell_code.get('metadata', {}).get('jupyter', {}).get('outputs_hidden', False)
-            is_open = (self.args['folding_mode'] == 'ignore') or (not is_outputs_hidden)
-            md_output = ['\n',
-                         '<details open>\n' if is_open else '<details>\n',
-                         '<summary>[{:d}]: outputs</summary>\n'.format(execution_count),
-                         '\n', *md_output, '\n', '</details>\n', '\n']
-
-        # length check
-        if len(cell_code['source']) == 0:
-            md_source = []
-        if len(cell_code['outputs']) == 0:
-            md_output = []
-
-        # merge
-        md = md_source + md_output
+        yield from ('\n', '</details>\n', '\n')
 
-        return md
+    def _merge_streams(self, outputs):
+        '''outputs where adjacent stream outputs of the same name are merged into one
+        '''
+        merged = None
+        for o in outputs:
+            if merged is not None and o['output_type'] == 'stream' and o['name'] == merged['name']:
+                merged['text'].extend(o['text'])
+                continue
+            if merged is not None:
+                yield merged
+                merged = None
+            if o['output_type'] == 'stream':
+                merged = dict(o, text=list(o['text']))
+            else:
+                yield o
+        if merged is not None:
+            yield merged
 
     def _process_output_stream(self, output_stream):
-        txt = [self._remove_ansi(l) for l in list(output_stream['text'])]
-        return ['\n', '```\n'] + txt + ['\n', '```\n', '\n']
+        yield from ('\n', '```\n')
+        # 進捗バーなどで上書きされた行は最終的な表示だけ残す
+        text = ''.join(output_stream['text'])
+        yield '\n'.join(self._overwrite_line(self._remove_ansi(l)) for l in text.split('\n'))
+        yield from ('\n', '```\n', '\n')
+
+    def _overwrite_line(self, l):
+        '''apply carriage returns and backspaces in a line as a terminal does
+        '''
+        if '\b' not in l:
+            buf = ''
+            for seg in l.split('\r'):
+                buf = seg + buf[len(seg):]
+            return buf
+
+        buf = []
+        pos = 0
+        for c in l:
+            if c == '\r':
+                pos = 0
+            elif c == '\b':
+                pos = max(pos - 1, 0)
+            elif pos < len(buf):
+                buf[pos] = c
+                pos += 1
+            else:
+                buf.append(c)
+                pos += 1
+        return ''.join(buf)
 
     def _process_output_result(self, output_result):
         if 'text/html' in output_result['data']:
-            md = ['\n', '\n'] + list(output_result['data']['text/html']) + ['\n', '\n']
+            yield from ('\n', '\n')
+            yield from output_result['data']['text/html']
+            yield from ('\n', '\n')
 
         elif 'text/latex' in output_result['data']:
-            md = []
-            for i, line in enumerate(output_result['data']['text/latex']):
+            for line in output_result['data']['text/latex']:
                 line = re.sub(r'\\\\', r'\\cr', line)
                 line = re.sub(r'\\begin{equation\*}', r'\n```math\n\\begin{equation*}', line)
                 line = re.sub(r'\\end{equation\*}', r'\\end{equation*}\n```\n', line)
-                md.append(line)
+                yield line
 
         else:  # text/plain
-            md = ['\n', '```\n'] + list(output_result['data']['text/plain']) + ['\n', '```\n', '\n']
-
-        return md
+            yield from ('\n', '```\n')
+            yield from output_result['data']['text/plain']
+            yield from ('\n', '```\n', '\n')
 
     def _process_output_disp(self, output_disp):
-        md = []
-
         if 'image/png' in output_disp['data']:
             alttxt = ''.join(output_disp['data'].get('text/plain', ['']))
-            path_img = self._save_encodedimage(output_disp['data']['image/png'])
-            try:
-                url = self._upload_image_and_get_url(path_img)
-                md.append('![{:s}]({:s})\n'.format(alttxt, url))
-            except RuntimeError:
-                md.append('<img src="data:image/png;base64,{:s}">\n'.format(output_disp['data']['image/png']))
+            yield ImageRef(Path('output.png'), None, self.TEMPLATES_OUTPUT_IMAGE,
+                           b64=output_disp['data']['image/png'], alt=alttxt)
 
         else:
-            md.append('![no image display_data output (unsupported)](error.png)')
-
-        return md
+            yield '![no image display_data output (unsupported)](error.png)'
 
     def _process_output_error(self, output_error):
-        txt = [self._remove_ansi(l) + '\n' for l in list(output_error['traceback'])]
-        return ['\n', '```\n'] + txt + ['```\n', '\n']
-
-    def _upload_image_and_get_url(self, path_img):
-        '''filepathからsha256を計算、ハッシュリストを参照してアップロード済みか確認する
-        未アップならアップロードしてURLを返す
-        アップ済みならURLを返す
+        yield from ('\n', '```\n')
+        for l in output_error['traceback']:
+            yield self._remove_ansi(l) + '\n'
+        yield from ('```\n', '\n')
 
-        エラー処理は読み出しもとで行う
+    def _get_notebook_hash(self):
+        '''hash of the notebook excluding metadata of esapy, which changes at every publish
         '''
-        d = self.nbjson['metadata']['esapy']['hashdict']
-        h = self._get_sha256(path_img)
+        nb = dict(self.nbjson, metadata={k: v for k, v in self.nbjson['metadata'].items() if k != 'esapy'})
+        s = json.dumps(nb, ensure_ascii=False, sort_keys=True)
+        return 'ipynb:' + hash_bytes(s.encode('utf-8'), self.args['hash_algorithm'])
 
-        if h not in d:  # unuploaded image
-            if self.args['dest'] == 'esa':
-                url, _ = api_esa.upload_binary(path_img,
-                                               token=self.args['token'],
-                                               team=self.args['team'],
-                                               proxy=self.args['proxy'])
-                d[h] = url  # record url and sha256
-            elif self.args['dest'] == 'growi':
-                url, _ = api_growi.upload_binary(path_img,
-                                                 token=self.args['token'],
-                                                 url=self.args['url'],
-                                                 proxy=self.args['proxy'])
-                d[h] = url  # record url and sha256
-            else:
-                raise RuntimeError('invalid dest.')
-
-        return d[h]
+    def _upload_notebook(self):
+        '''upload the notebook itself and return its url
 
-    def _save_encodedimage(self, s_b64):
-        '''base64-encoded-multiline-png-data を一時ファイルに保存して、ファイルパスを返す
-        '''
-        p = self._mkstemp(suffix='.png')
-        with p.open('wb') as f:
-            dat = base64.b64decode(s_b64)
-            f.write(dat)
-        return p
-
-    def _mkstemp(self, **kwargs):
-        '''一時ファイルを確保してファイルパスを返す
+        If the notebook is unchanged since the previous publish, the previous attachment is reused,
+        so that the post body does not change.
         '''
-        args = dict(dict(dir=self.path_pwd), **kwargs)
-        fd, fn_tmp = tempfile.mkstemp(**args)
-        self._fd_list.append(fd)
-        return Path(fn_tmp)
-
-    def _get_sha256(self, path_file):
-        '''指定したファイルのsha256を算出
+        h = self._get_notebook_hash()
+        base = self._get_base()
+        prev = self.nbjson['metadata']['esapy'].get('ipynb_attachment', {})
+        if prev.get('hash', None) == h and prev.get('dest', None) == self.args['dest'] and prev.get('base', None) == base:
+            logger.info('Notebook is unchanged. -> previous attachment is reused, url={:s}'.format(prev['url']))
+            return prev['url']
+
+        url, _ = self._upload_binary(self.path_input, h)
+        self.nbjson['metadata']['esapy']['ipynb_attachment'] = dict(hash=h, dest=self.args['dest'], base=base, url=url)
+        return url
+
+    def _record_upload_page(self):
+        '''record the user page for attachments (growi), to skip looking it up next time
         '''
-        m = hashlib.sha256()
-        with Path(path_file).open('rb') as f:
-            m.update(f.read())
-        return m.hexdigest()
+        if self.args['dest'] != 'growi':
+            return
+        d = api_growi.dump_upload_page(token=self.args['token'],
+                                       url=self.args['url'],
+                                       proxy=self.args['proxy'])
+        if d is not None:
+            self.nbjson['metadata']['esapy']['growi_upload_page'] = d
 
     def upload_body(self):
         # load temp ipynb
@@ -868,18 +1261,7 @@ class IpynbProcessor(EsapyProcessorBase):
 
         # upload ipynb itself and insert link
         try:
-            if self.args['dest'] == 'esa':
-                ipynb_url, _ = api_esa.upload_binary(self.path_input,
-                                                     token=self.args['token'],
-                                                     team=self.args['team'],
-                                                     proxy=self.args['proxy'])
-            elif self.args['dest'] == 'growi':
-                ipynb_url, _ = api_growi.upload_binary(self.path_input,
-                                                       token=self.args['token'],
-                                                       url=self.args['url'],
-                                                       proxy=self.args['proxy'])
-            else:
-                raise RuntimeError('invalid dest.')
+            ipynb_url = self._upload_notebook()
 
             s_link = 'ipynb file -> [{:s}]({:s})\n\n'.format(str(self.path_input), ipynb_url)
             md_body = s_link + md_body
@@ -891,7 +1273,17 @@ class IpynbProcessor(EsapyProcessorBase):
         msg_warnforedit += '<!-- このテキストは jupyter notebook から自動生成されたものです。このテキストを直接編集することは避け、元のipynbファイルを編集した後に再度アップロードしてください。 -->\n\n\n'
         md_body = msg_warnforedit + md_body
 
+        # skip publishing if nothing is changed since the previous publish
+        digest = self._get_publish_digest(md_body, info_dict)
+        if self._is_unchanged(digest):
+            logger.info('Body and attributes of the post are unchanged. ==> publishing is skipped')
+            self.summary['publish'] = 'skipped (unchanged)'
+            self.result_upload = True
+            self._save_intermediate_ipynb()
+            return self._get_post_url()
+
         # post / patch
+        self.summary['publish'] = 'created' if self.get_post_number() is None or self.args['post_mode'] == 'new' else 'updated'
         if self.args['dest'] == 'esa':
             logger.debug('create or patch post to esa')
             post_url, res = self._create_or_patch_post_esa(md_body, info_dict)
@@ -903,6 +1295,11 @@ class IpynbProcessor(EsapyProcessorBase):
         logger.info('Created/patched post')
 
         self.post_info = res.json()
+        if self.args['dest'] == 'esa':
+            self.post_info['etag'] = res.headers.get('ETag', None)  # for conditional lookup at the next update
+        if self.args['dest'] == 'growi':
+            self.post_info = self.post_info.get('data', self.post_info)  # response of v3 api is wrapped in `data`
+            self.post_info['revision_id'] = api_growi.get_revision_id(self.post_info)  # used at the next update
         self.nbjson['metadata']['esapy']['post_info'] = self.post_info
         try:
             # clear body, because body is generally large but didn't be used,
@@ -911,13 +1308,60 @@ class IpynbProcessor(EsapyProcessorBase):
         except KeyError:
             logger.info('metadata body was not found. ==> skipped.')
         self.result_upload = self.is_uploaded()
+        if self.args['dest'] == 'esa':
+            # attributes of the post may be normalized by the server, e.g. name of a new post
+            digest = self._get_publish_digest(md_body, self.post_info)
+        self.nbjson['metadata']['esapy']['publish_digest'] = dict(hash=digest,
+                                                                  updated_at=self.post_info.get('updated_at', None),
+                                                                  revision_id=self.post_info.get('revision_id', None))
 
+        self._save_intermediate_ipynb()
+
+        return post_url
+
+    def _is_unchanged(self, digest):
+        '''True if the post is published with the same digest, and not modified on the server after that
+
+        esa.io: `updated_at` of the post looked up by `gather_post_info` is compared.
+        growi: the latest revision of the page is fetched, only if the digest matches.
+        '''
+        if self.args['force_update'] or self.args['post_mode'] == 'new' or not self.is_uploaded():
+            return False
+        prev = self.nbjson['metadata']['esapy'].get('publish_digest', {})
+        if prev.get('hash', None) != digest:
+            return False
+        if self.args['dest'] == 'growi':
+            return prev.get('revision_id', None) is not None and prev['revision_id'] == self._get_latest_revision_growi()
+        post_info = self.nbjson['metadata']['esapy']['post_info']
+        return prev.get('updated_at', None) == post_info.get('updated_at', None)
+
+    def _get_latest_revision_growi(self):
+        '''revision id of the page on the server, or None if it cannot be fetched
+        '''
+        try:
+            page = api_growi.get_post(self.get_post_number(),
+                                      token=self.args['token'],
+                                      url=self.args['url'],
+                                      proxy=self.args['proxy'])
+        except RuntimeError as e:
+            logger.info('getting the latest revision failed: {:}'.format(e))
+            return None
+        return api_growi.get_revision_id(page)
+
+    def _get_post_url(self):
+        '''url of the post recorded at the previous publish
+        '''
+        post_info = self.nbjson['metadata']['esapy']['post_info']
+        if self.args['dest'] == 'esa':
+            return post_info['url']
+        return self.args['url'] + '/' + post_info['page']['path']
+
+    def _save_intermediate_ipynb(self):
+        self._record_upload_page()
         with self.path_ipynb.open('w', encoding='utf-8') as f:
             json.dump(self.nbjson, f, ensure_ascii=False, indent=4, sort_keys=True, separators=(',', ': '))
             logger.info('Intermediate ipynb file has been saved.')
 
-        return post_url
-
     def _create_or_patch_post_esa(self, md_body, info_dict):
         post_number = self.get_post_number()
         if post_number is None or self.args['post_mode'] == 'new':
@@ -961,7 +1405,8 @@ class IpynbProcessor(EsapyProcessorBase):
                                                  name=info_dict.get('name', self.path_input.name),
                                                  token=self.args['token'],
                                                  url=self.args['url'],
-                                                 proxy=self.args['proxy'])
+                                                 proxy=self.args['proxy'],
+                                                 revision_id=self.nbjson['metadata']['esapy']['post_info'].get('revision_id', None))
 
         return post_url, res
 
@@ -990,6 +1435,10 @@ class IpynbProcessor(EsapyProcessorBase):
         else:
             logger.info('no-output mode')
 
+        # hashdict has been saved, or is not saved at all in no-output mode
+        # (uploads are reused via the upload cache then)
+        self.journal.clear()
+
     def get_post_number(self):
         try:
             if self.args['dest'] == 'esa':
@@ -1052,18 +1501,23 @@ class IpynbProcessor(EsapyProcessorBase):
         info_prev_metadata = self.nbjson['metadata']['esapy']['post_info']  # post_info written in metadata
         number = info_prev_metadata['number']
         info_prev = {}
-        if number is not None:
+        if number is not None and self.args['post_lookup'] == 'never':
+            logger.info('post_number is not None, but lookup is skipped. -> using post_info in metadata')
+            info_prev = info_prev_metadata
+        elif number is not None:
             logger.info('post_number is not None. -> checking post/{:d} ...'.format(number))
             try:
-                info_prev = api_esa.get_post(number,
-                                             token=self.args['token'],
-                                             team=self.args['team'],
-                                             proxy=self.args['proxy'])
+                info_prev = self._get_post_esa(number, info_prev_metadata)
                 logger.info('getting post/{:d} was succeeded.'.format(number))
-            except RuntimeError as e:
-                logger.info('getting post/{:d} was failed. -> clearing post_number to set as None.'.format(number))
+            except api_esa.PostNotFound:
+                logger.info('post/{:d} is not found. -> clearing post_number to set as None.'.format(number))
                 info_prev = info_prev_metadata
                 info_prev['number'] = None
+            except (NetworkError, DeadlineExceeded, DestinationUnavailable):
+                raise  # the post may exist, so a new post must not be created
+            except RuntimeError as e:
+                logger.warning('getting post/{:d} was failed. -> using post_info in metadata'.format(number))
+                info_prev = info_prev_metadata
         else:
             info_prev = info_prev_metadata
         logger.info('info_prev has been gathered.')
@@ -1098,6 +1552,33 @@ class IpynbProcessor(EsapyProcessorBase):
 
         return d
 
+    def _get_post_esa(self, number, info_prev_metadata):
+        '''get attributes of the post, downloading them only if the post was modified
+
+        ETag / updated_at are cached in post_info of metadata.
+        '''
+        if self.args['post_lookup'] == 'always':
+            info = api_esa.get_post(number,
+                                    token=self.args['token'],
+                                    team=self.args['team'],
+                                    proxy=self.args['proxy'])
+            # updated_at is compared with publish_digest, body is not kept
+            info_prev_metadata.update({k: v for k, v in info.items() if k not in ('body_md', 'body_html')})
+            return info
+
+        info, etag = api_esa.get_post_info(number,
+                                           token=self.args['token'],
+                                           team=self.args['team'],
+                                           proxy=self.args['proxy'],
+                                           etag=info_prev_metadata.get('etag', None),
+                                           updated_at=info_prev_metadata.get('updated_at', None))
+        if info is None:  # not modified
+            info = info_prev_metadata
+        else:
+            info_prev_metadata.update(info)
+        info_prev_metadata['etag'] = etag
+        return info
+
     def _remove_ansi(self, s):
         return re.sub(r'\x1b[^m]*m', '', s)
 
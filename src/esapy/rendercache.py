@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from .uploadcache import get_cache_dir
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class RenderCache(object):
+    '''persistent map of rendered cells, digest -> serialized fragments (str)
+
+    Stored next to the upload cache, and shared by all notebooks.
+    The least recently used entries beyond `max_entries` are evicted when the cache is closed.
+    '''
+
+    FILENAME = 'cells.sqlite3'
+
+    def __init__(self, cache_dir=None, max_entries=20000):
+        self.path = Path(cache_dir if cache_dir is not None else get_cache_dir()).expanduser() / self.FILENAME
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cells (digest TEXT PRIMARY KEY, value TEXT, used_at REAL)')
+        logger.info('render cache={:s}'.format(str(self.path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, digest):
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT value FROM cells WHERE digest=?', (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE cells SET used_at=? WHERE digest=?', (time.time(), digest))
+        return row[0]
+
+    def put(self, digest, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO cells VALUES (?, ?, ?)', (digest, value, time.time()))
+
+    def evict(self):
+        with self._lock, self._conn:
+            n = self._conn.execute('DELETE FROM cells WHERE rowid NOT IN'
+                                   ' (SELECT rowid FROM cells ORDER BY used_at DESC LIMIT ?)',
+                                   (self.max_entries,)).rowcount
+        if n > 0:
+            logger.info('{:d} entries are evicted from render cache.'.format(n))
+        return n
+
+    def close(self):
+        try:
+            self.evict()
+        finally:
+            self._conn.close()
+        logger.info('render cache: {:d} hits, {:d} misses'.format(self.hits, self.misses))
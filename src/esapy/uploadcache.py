@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+def get_cache_dir():
+    '''$XDG_CACHE_HOME/esapy (default: ~/.cache/esapy)
+    '''
+    base = os.environ.get('XDG_CACHE_HOME', '')
+    base = Path(base) if base != '' else Path.home() / '.cache'
+    return base / 'esapy'
+
+
+class UploadCache(object):
+    '''persistent map of uploaded contents, (dest, base, hash) -> url
+
+    `base` is the team name (esa.io) or url (growi). The cache is shared by all
+    notebooks and files uploaded from this machine, and it is safe to be used by
+    parallel runs (SQLite in WAL mode) and threads.
+
+    Entries unused for `max_age` days and the least recently used ones beyond
+    `max_entries` are evicted when the cache is closed.
+
+    Digests of local files memoized by `FileHasher` are also stored here.
+    '''
+
+    FILENAME = 'uploads.sqlite3'
+    CHECK_TTL = 7 * 86400  # sec, urls are not checked again within this period
+
+    def __init__(self, cache_dir=None, max_entries=100000, max_age=180):
+        self.path = Path(cache_dir if cache_dir is not None else get_cache_dir()).expanduser() / self.FILENAME
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                               ' dest TEXT, base TEXT, hash TEXT, url TEXT, size INTEGER,'
+                               ' created_at REAL, used_at REAL,'
+                               ' PRIMARY KEY (dest, base, hash))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS url_checks (url TEXT PRIMARY KEY, checked_at REAL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS digests ('
+                               ' path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER,'
+                               ' scheme TEXT, digest TEXT, used_at REAL,'
+                               ' PRIMARY KEY (path, scheme))')
+        logger.info('upload cache={:s}'.format(str(self.path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, dest, base, h):
+        '''url of uploaded content, or None
+        '''
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT url FROM uploads WHERE dest=? AND base=? AND hash=?',
+                                     (dest, base, h)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE uploads SET used_at=? WHERE dest=? AND base=? AND hash=?',
+                               (time.time(), dest, base, h))
+        logger.debug('upload cache hit: {:s} -> {:s}'.format(h, row[0]))
+        return row[0]
+
+    def put(self, dest, base, h, url, size=None):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (dest, base, h, url, size, now, now))
+
+    def invalidate(self, dest, base, h):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM uploads WHERE dest=? AND base=? AND hash=?', (dest, base, h))
+
+    def forget(self, hashes):
+        '''remove uploads of the contents for any destination, return number of removed entries
+        '''
+        n = 0
+        with self._lock, self._conn:
+            for h in hashes:
+                n += self._conn.execute('DELETE FROM uploads WHERE hash=?', (h,)).rowcount
+        return n
+
+    def needs_check(self, url):
+        '''True if liveness of url has not been checked within CHECK_TTL
+        '''
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT checked_at FROM url_checks WHERE url=?', (url,)).fetchone()
+        return row is None or row[0] < time.time() - self.CHECK_TTL
+
+    def record_check(self, url):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO url_checks VALUES (?, ?)', (url, time.time()))
+
+    def get_digest(self, key, scheme):
+        '''digest of a file memoized by FileHasher, key=(path, size, mtime_ns, inode)
+        '''
+        path, size, mtime_ns, inode = key
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT digest FROM digests WHERE path=? AND scheme=?'
+                                     ' AND size=? AND mtime_ns=? AND inode=?',
+                                     (path, scheme, size, mtime_ns, inode)).fetchone()
+            if row is not None:
+                self._conn.execute('UPDATE digests SET used_at=? WHERE path=? AND scheme=?',
+                                   (time.time(), path, scheme))
+        return row[0] if row is not None else None
+
+    def put_digest(self, key, scheme, digest):
+        path, size, mtime_ns, inode = key
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (path, size, mtime_ns, inode, scheme, digest, time.time()))
+
+    def evict(self):
+        '''remove entries by age and count, return number of removed entries
+        '''
+        with self._lock, self._conn:
+            n = 0
+            if self.max_age is not None:
+                n += self._conn.execute('DELETE FROM uploads WHERE used_at < ?',
+                                        (time.time() - self.max_age * 86400,)).rowcount
+                self._conn.execute('DELETE FROM digests WHERE used_at < ?',
+                                   (time.time() - self.max_age * 86400,))
+            self._conn.execute('DELETE FROM url_checks WHERE checked_at < ?', (time.time() - self.CHECK_TTL,))
+            if self.max_entries is not None:
+                n += self._conn.execute('DELETE FROM uploads WHERE rowid NOT IN'
+                                        ' (SELECT rowid FROM uploads ORDER BY used_at DESC LIMIT ?)',
+                                        (self.max_entries,)).rowcount
+        if n > 0:
+            logger.info('{:d} entries are evicted from upload cache.'.format(n))
+        return n
+
+    def close(self):
+        try:
+            self.evict()
+        finally:
+            self._conn.close()
+        logger.info('upload cache: {:d} hits, {:d} misses'.format(self.hits, self.misses))
+
+
+class UploadJournal(object):
+    '''append-only log of finished uploads of images in a file, to resume an interrupted run
+
+    Each upload is written as a line of JSON (dest, base, hash, url) and fsynced as soon as
+    it finishes, so it survives even if the process is killed before the file is saved.
+    The journal is replayed into hashdict at the next run, and cleared after hashdict is saved in the file.
+    If `path_target` is None, nothing is journaled.
+    '''
+
+    def __init__(self, path_target, cache_dir=None):
+        self.path = None
+        if path_target is not None:
+            key = hashlib.sha256(str(Path(path_target).resolve()).encode('utf-8')).hexdigest()[:16]
+            base = Path(cache_dir if cache_dir is not None else get_cache_dir()).expanduser()
+            self.path = base / 'journal' / (key + '.jsonl')
+        self._f = None
+        self._lock = threading.Lock()
+
+    def replay(self, dest, base):
+        '''dict of hash -> url recorded for (dest, base)
+        '''
+        d = {}
+        if self.path is None or not self.path.exists():
+            return d
+        with self.path.open('r', encoding='utf-8') as f:
+            for l in f:
+                try:
+                    e = json.loads(l)
+                except ValueError:
+                    continue  # torn line written at a crash
+                if e.get('dest', None) == dest and e.get('base', None) == base:
+                    d[e['hash']] = e['url']
+        logger.debug('{:d} uploads are found in journal={:s}'.format(len(d), str(self.path)))
+        return d
+
+    def append(self, dest, base, h, url):
+        if self.path is None:
+            return
+        line = json.dumps(dict(dest=dest, base=base, hash=h, url=url), ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._f is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._f = self.path.open('a', encoding='utf-8')
+                if self._is_torn():
+                    self._f.write('\n')  # do not continue a line torn at a crash
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def _is_torn(self):
+        with self.path.open('rb') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def clear(self):
+        self.close()
+        if self.path is not None and self.path.exists():
+            self.path.unlink()
+            logger.debug('journal={:s} is cleared.'.format(str(self.path)))
@@ -0,0 +1,33 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from esapy import api_esa, api_growi
+
+
+class FakeResponse(object):
+    '''minimal stand-in for requests.Response
+    '''
+    def __init__(self, status_code=200, d=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._d = d
+
+    def json(self):
+        return json.loads(json.dumps(self._d))
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    '''records the file names passed to upload_binary of esa and growi, returns https://example.com/<n>
+    '''
+    uploaded = []
+
+    def fake_upload(filename, *args, data=None, **kwargs):
+        uploaded.append(Path(filename).name)
+        return 'https://example.com/{:d}'.format(len(uploaded)), None
+
+    monkeypatch.setattr(api_esa, 'upload_binary', fake_upload)
+    monkeypatch.setattr(api_growi, 'upload_binary', fake_upload)
+    return uploaded
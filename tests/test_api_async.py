@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+
+from esapy import api_esa
+from esapy.api_async import AsyncClient
+
+
+def test_upload_many(monkeypatch):
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+
+    def fake_upload(filename, token=None, team=None, proxy=None):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return 'https://example.com/' + filename, None
+
+    monkeypatch.setattr(api_esa, 'upload_binary', fake_upload)
+    filenames = ['{:d}.png'.format(i) for i in range(16)]
+
+    async def main():
+        async with AsyncClient('esa', token='token', team='team', max_concurrency=8) as client:
+            return await client.upload_many(filenames)
+
+    t = time.monotonic()
+    urls = asyncio.run(main())
+    assert urls == ['https://example.com/' + fn for fn in filenames]
+    assert running[1] == 8
+    assert time.monotonic() - t < 0.05 * 16 / 2
+
+
+def test_close_waits_for_calls_in_flight(monkeypatch):
+    finished = []
+
+    def fake_upload(filename, token=None, team=None, proxy=None):
+        time.sleep(0.05)
+        finished.append(filename)
+        return 'https://example.com/' + filename, None
+
+    monkeypatch.setattr(api_esa, 'upload_binary', fake_upload)
+
+    async def main():
+        async with AsyncClient('esa', token='token', team='team') as client:
+            asyncio.ensure_future(client.upload_binary('a.png'))
+            await asyncio.sleep(0.01)  # started but not finished
+
+    asyncio.run(main())
+    assert finished == ['a.png']
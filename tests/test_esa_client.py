@@ -0,0 +1,27 @@
+from esapy import api_esa
+
+from .conftest import FakeResponse
+
+
+def test_get_post_info(monkeypatch):
+    client = api_esa.get_client('token', 'team', None)
+    sent = []
+    responses = [FakeResponse(304, headers={'ETag': 'W/"e1"'}),
+                 FakeResponse(200, dict(number=1, name='x', body_md='# x', body_html='<h1>x</h1>'), {'ETag': 'W/"e2"'})]
+
+    def fake_request(method, url, headers=None, **kwargs):
+        sent.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    try:
+        info, etag = api_esa.get_post_info(1, token='token', team='team',
+                                           etag='W/"e1"', updated_at='2021-07-26T10:00:00+09:00')
+        assert info is None and etag == 'W/"e1"'
+        assert sent[0] == {'If-None-Match': 'W/"e1"', 'If-Modified-Since': 'Mon, 26 Jul 2021 01:00:00 GMT'}
+
+        info, etag = api_esa.get_post_info(1, token='token', team='team')
+        assert info == dict(number=1, name='x') and etag == 'W/"e2"'
+        assert sent[1] == {}
+    finally:
+        api_esa._registry.close()
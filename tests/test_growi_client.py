@@ -0,0 +1,91 @@
+from urllib.parse import urlsplit
+
+import pytest
+
+from esapy import api_growi
+
+from .conftest import FakeResponse
+
+
+@pytest.fixture
+def growi(monkeypatch):
+    '''a growi client whose session answers from `routes`, key=(method, path), value=list of responses
+    '''
+    monkeypatch.setenv('GROWI_USERNAME', 'me')
+    url = 'http://growi'
+    client = api_growi.get_client('token', url, None)
+    routes = {}
+    calls = []
+
+    def fake_request(method, u, **kwargs):
+        key = (method, urlsplit(u).path)
+        data = kwargs.get('data')
+        calls.append((key, data if isinstance(data, dict) else kwargs.get('params')))
+        responses = routes[key]
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    yield url, routes, calls
+    api_growi._registry.close()
+
+
+def _paths(calls):
+    return [key[1] for key, _ in calls]
+
+
+def _attachment(name):
+    return FakeResponse(200, {'ok': True, 'attachment': {'filePathProxied': '/attachment/' + name}})
+
+
+def test_upload_page_is_looked_up_once(growi, tmp_path):
+    url, routes, calls = growi
+    routes[('GET', '/_api/pages.get')] = [FakeResponse(200, {'page': {'_id': 'p1'}})]
+    routes[('POST', '/_api/attachments.add')] = [_attachment('a')]
+
+    p = tmp_path / 'a.png'
+    p.write_bytes(b'png')
+    for _ in range(5):
+        assert api_growi.upload_binary(p, token='token', url=url)[0] == '/attachment/a'
+    assert _paths(calls).count('/_api/pages.get') == 1
+    assert _paths(calls).count('/_api/attachments.add') == 5
+
+
+def test_upload_page_is_seeded_and_refreshed_once(growi, tmp_path):
+    url, routes, calls = growi
+    api_growi.load_upload_page(dict(url=url, user='me', page_id='removed'), token='token', url=url)
+    routes[('GET', '/_api/pages.get')] = [FakeResponse(200, {'page': {'_id': 'p1'}})]
+    routes[('POST', '/_api/attachments.add')] = [FakeResponse(200, {'ok': False, 'error': 'page not found'}),
+                                                 _attachment('a')]
+
+    p = tmp_path / 'a.png'
+    p.write_bytes(b'png')
+    assert api_growi.upload_binary(p, token='token', url=url)[0] == '/attachment/a'
+    assert api_growi.upload_binary(p, token='token', url=url)[0] == '/attachment/a'
+    assert _paths(calls) == ['/_api/attachments.add', '/_api/pages.get', '/_api/attachments.add', '/_api/attachments.add']
+    assert api_growi.dump_upload_page(token='token', url=url) == dict(url=url, user='me', page_id='p1')
+
+
+def _updated(rev):
+    return FakeResponse(200, {'ok': True, 'page': {'_id': 'p9', 'path': '/user/me/x', 'revision': rev}})
+
+
+@pytest.mark.parametrize('stale', [FakeResponse(409, {}),
+                                   FakeResponse(200, {'ok': False, 'error': 'Posted param "revisionId" is outdated.'})])
+def test_patch_post_with_stale_revision(growi, stale):
+    url, routes, calls = growi
+    routes[('POST', '/_api/pages.update')] = [stale, _updated('r3')]
+    routes[('GET', '/_api/pages.get')] = [FakeResponse(200, {'page': {'_id': 'p9', 'revision': {'_id': 'r2'}}})]
+
+    pageurl, res = api_growi.patch_post('p9', 'body', 'x', token='token', url=url, revision_id='r1')
+    assert pageurl == url + '//user/me/x'
+    assert api_growi.get_revision_id(res.json()) == 'r3'
+    assert _paths(calls) == ['/_api/pages.update', '/_api/pages.get', '/_api/pages.update']
+    assert [d['revision_id'] for key, d in calls if key[1] == '/_api/pages.update'] == ['r1', 'r2']
+
+
+def test_patch_post_with_latest_revision(growi):
+    url, routes, calls = growi
+    routes[('POST', '/_api/pages.update')] = [_updated('r2')]
+
+    api_growi.patch_post('p9', 'body', 'x', token='token', url=url, revision_id='r1')
+    assert _paths(calls) == ['/_api/pages.update']
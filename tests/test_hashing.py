@@ -0,0 +1,67 @@
+import hashlib
+import struct
+import zlib
+
+from esapy.hashing import png_fingerprint, hash_bytes, hash_file, FileHasher
+from esapy.uploadcache import UploadCache
+
+
+def _chunk(ctype, body):
+    return struct.pack('>I', len(body)) + ctype + body + struct.pack('>I', zlib.crc32(ctype + body) & 0xffffffff)
+
+
+def _png(pixels, level=6, text=None, split=None):
+    w, h = 4, 2
+    raw = b''.join(b'\x00' + pixels[y * w * 3:(y + 1) * w * 3] for y in range(h))
+    z = zlib.compress(raw, level)
+    idat = [z] if split is None else [z[:split], z[split:]]
+    out = b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+    if text is not None:
+        out += _chunk(b'tEXt', text)
+    out += b''.join(_chunk(b'IDAT', c) for c in idat)
+    return out + _chunk(b'IEND', b'')
+
+
+def test_png_fingerprint_ignores_metadata_and_compression():
+    pixels = bytes(range(24))
+    h = png_fingerprint(_png(pixels))
+    assert h.startswith('png:')
+    assert png_fingerprint(_png(pixels, level=1, text=b'Software\x00matplotlib')) == h
+    assert png_fingerprint(_png(pixels, split=5)) == h
+    assert png_fingerprint(_png(bytes(reversed(pixels)))) != h
+
+
+def test_png_fingerprint_rejects_other_data():
+    assert png_fingerprint(b'GIF89a....') is None
+    assert png_fingerprint(_png(bytes(range(24)))[:40]) is None
+
+
+def test_hash_file_in_chunks(tmp_path):
+    p = tmp_path / 'a.bin'
+    data = bytes(range(256)) * 100
+    p.write_bytes(data)
+    assert hash_file(p, chunk_size=1000) == hashlib.sha256(data).hexdigest()
+    assert hash_file(p, 'blake2b', chunk_size=1000) == 'blake2b:' + hashlib.blake2b(data).hexdigest()
+    assert hash_bytes(data, 'blake2b') == hash_file(p, 'blake2b')
+
+
+def test_file_hasher_memo(tmp_path):
+    paths = []
+    for i in range(3):
+        p = tmp_path / '{:d}.bin'.format(i)
+        p.write_bytes(bytes([i]) * 10)
+        paths.append(p)
+
+    with UploadCache(tmp_path / 'cache') as cache:
+        hasher = FileHasher(store=cache)
+        res = hasher.hash_files(paths + [tmp_path / 'missing.bin'])
+        assert len(res) == 3 and (hasher.hits, hasher.misses) == (0, 3)
+        hasher.hash(paths[0])
+        assert (hasher.hits, hasher.misses) == (1, 3)
+
+        # persisted in the cache, and invalidated by modification
+        paths[1].write_bytes(b'modified')
+        hasher = FileHasher(store=cache)
+        assert hasher.hash(paths[0]) == res[paths[0]]
+        assert hasher.hash(paths[1]) == hashlib.sha256(b'modified').hexdigest()
+        assert (hasher.hits, hasher.misses) == (1, 1)
@@ -0,0 +1,140 @@
+import time
+
+import pytest
+import requests
+
+from esapy import httpclient
+from esapy.httpclient import HttpClient, RateLimit, NetworkError
+
+from .conftest import FakeResponse
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    slept = []
+    monkeypatch.setattr(httpclient.time, 'sleep', slept.append)
+    return slept
+
+
+def _client_with_responses(monkeypatch, responses):
+    c = HttpClient()
+    it = iter(responses)
+
+    def fake_request(method, url, **kwargs):
+        r = next(it)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    monkeypatch.setattr(c.session, 'request', fake_request)
+    return c
+
+
+def test_ratelimit_paces_before_exhaustion():
+    rl = RateLimit()
+    now = 1000.0
+    rl.update({'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '50', 'X-RateLimit-Reset': '1100'})
+    assert rl.acquire(now) == 0.0
+
+    rl.update({'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '5', 'X-RateLimit-Reset': '1100'})
+    assert rl.acquire(now) == pytest.approx(100.0 / 5)
+
+    rl.update({'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1100'})
+    assert rl.acquire(now) == pytest.approx(100.0)
+    assert rl.acquire(1200.0) == 0.0  # window has been reset
+
+
+def test_retry_transient_status(monkeypatch, no_sleep):
+    c = _client_with_responses(monkeypatch, [FakeResponse(503),
+                                             FakeResponse(429, headers={'Retry-After': '7'}),
+                                             FakeResponse(200)])
+    res = c.post('http://example.com/x')
+    assert res.status_code == 200
+    assert c.stats['retries'] == 2
+    assert no_sleep[-1] >= 7
+    assert c.stats['wait_backoff'] == pytest.approx(sum(no_sleep))
+
+
+@pytest.mark.parametrize('status', [502, 504])
+def test_post_is_not_resent_on_gateway_error(monkeypatch, no_sleep, status):
+    c = _client_with_responses(monkeypatch, [FakeResponse(status), FakeResponse(200)])
+    assert c.post('http://example.com/x').status_code == status
+    assert c.stats['requests'] == 1
+
+    c = _client_with_responses(monkeypatch, [FakeResponse(status), FakeResponse(200)])
+    assert c.get('http://example.com/x').status_code == 200
+
+
+def test_give_up_after_max_retries(monkeypatch, no_sleep):
+    monkeypatch.setitem(httpclient.config, 'max_retries', 2)
+    c = _client_with_responses(monkeypatch, [FakeResponse(503)] * 3)
+    assert c.get('http://example.com/x').status_code == 503
+    assert c.stats['requests'] == 3
+
+
+def test_connection_error_is_not_retried_for_post(monkeypatch, no_sleep):
+    c = _client_with_responses(monkeypatch, [requests.ConnectionError('down'), FakeResponse(200)])
+    with pytest.raises(NetworkError):
+        c.post('http://example.com/x')
+
+    c = _client_with_responses(monkeypatch, [requests.ConnectionError('down'), FakeResponse(200)])
+    assert c.get('http://example.com/x').status_code == 200
+
+
+def test_deadline_cancels_requests(monkeypatch, no_sleep):
+    c = _client_with_responses(monkeypatch, [FakeResponse(503), FakeResponse(200)])
+    monkeypatch.setitem(httpclient.config, 'deadline', 1.0)
+    monkeypatch.setattr(httpclient, '_deadline_at', time.monotonic() + 0.5)
+    monkeypatch.setattr(httpclient, 'backoff_delay', lambda attempt: 10.0)
+    with pytest.raises(httpclient.DeadlineExceeded):
+        c.get('http://example.com/x')  # backoff would outlive the deadline
+
+    monkeypatch.setattr(httpclient, '_deadline_at', time.monotonic() - 0.1)
+    with pytest.raises(httpclient.DeadlineExceeded):
+        c.get('http://example.com/x')
+    assert c.stats['requests'] == 1
+
+
+def test_circuit_breaker_fails_fast(monkeypatch, no_sleep):
+    monkeypatch.setitem(httpclient.config, 'breaker_threshold', 3)
+    c = _client_with_responses(monkeypatch, [FakeResponse(503)] * 3 + [FakeResponse(200)] * 2)
+    with pytest.raises(httpclient.DestinationUnavailable):
+        c.get('http://example.com/x')
+    assert c.stats['requests'] == 3
+    assert not c.is_available('http://example.com/y')
+
+    # other hosts are not affected
+    assert c.get('http://api.example.org/x').status_code == 200
+
+    # after cool-down, one success closes the breaker
+    c._get_breaker('http://example.com/x').opened_at -= httpclient.config['breaker_cooldown']
+    assert c.get('http://example.com/x').status_code == 200
+    assert c.is_available('http://example.com/y')
+
+
+def test_token_bucket_limits_throughput(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(httpclient.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(httpclient.time, 'sleep', lambda sec: clock.__setitem__(0, clock[0] + sec))
+
+    bucket = httpclient.TokenBucket(rate=1000)
+    for _ in range(5):
+        bucket.consume(1000)
+    # the first second of traffic is the burst, the rest has to wait
+    assert clock[0] == pytest.approx(4.0)
+    assert bucket.throttled == pytest.approx(4.0)
+    assert bucket.consumed == 5000
+
+    unlimited = httpclient.TokenBucket()
+    unlimited.consume(10 ** 9)
+    assert unlimited.throttled == 0
+
+
+def test_is_alive(monkeypatch, no_sleep):
+    monkeypatch.setitem(httpclient.config, 'max_retries', 0)
+    c = _client_with_responses(monkeypatch, [FakeResponse(302), FakeResponse(404), FakeResponse(403),
+                                             requests.ConnectionError('x')])
+    assert c.is_alive('http://example.com/a') is True
+    assert c.is_alive('http://example.com/a') is False
+    assert c.is_alive('http://example.com/a') is None  # unknown
+    assert c.is_alive('http://example.com/a') is None
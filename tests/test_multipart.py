@@ -0,0 +1,44 @@
+import io
+import os
+
+import requests
+
+from esapy.multipart import MultipartEncoder
+
+
+def _encode(fields, data, **kwargs):
+    return MultipartEncoder(fields, ('file', 'a.png', io.BytesIO(data), 'image/png'), boundary='xxBOUNDARYxx', **kwargs)
+
+
+def test_body_matches_requests():
+    data = os.urandom(200000)
+    fields = [('key', 'uploads/a.png'), ('policy', 'abc')]
+    enc = _encode(fields, data)
+
+    req = requests.Request('POST', 'http://example.com/',
+                           data=dict(fields),
+                           files=dict(file=('a.png', io.BytesIO(data), 'image/png'))).prepare()
+    boundary = req.headers['Content-Type'].split('boundary=')[1].encode()
+    expected = req.body.replace(boundary, b'xxBOUNDARYxx')
+
+    assert len(enc) == len(expected)
+    assert enc.read() == expected
+
+
+def test_chunked_read_and_rewind():
+    data = os.urandom(100000)
+    sent = []
+    enc = _encode([('page_id', 'p')], data, callback=lambda n, total: sent.append((n, total)))
+
+    chunks = []
+    while True:
+        c = enc.read(8192)
+        if not c:
+            break
+        assert len(c) <= 8192
+        chunks.append(c)
+    body = b''.join(chunks)
+    assert len(body) == len(enc) == sent[-1][0] == sent[-1][1]
+
+    enc.seek(0)
+    assert enc.read() == body
@@ -0,0 +1,357 @@
+import base64
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+import requests
+
+from esapy import api_esa, api_growi, httpclient
+from esapy.entrypoint import parser
+from esapy.helper import reset_ipynb
+from esapy.processor import IpynbProcessor, MarkdownProcessor
+from esapy.uploadcache import UploadCache, UploadJournal
+
+from .conftest import FakeResponse
+
+DATA = Path(__file__).parent / 'data'
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''notebook in a temporary directory, and fake uploads which return a url derived from the content
+    '''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('GROWI_USERNAME', 'me')
+
+    def fake_upload(filename, *args, data=None, **kwargs):
+        if data is None:
+            data = Path(filename).read_bytes()
+        return 'https://example.com/' + hashlib.sha256(data).hexdigest()[:10], None
+
+    monkeypatch.setattr(api_esa, 'upload_binary', fake_upload)
+    monkeypatch.setattr(api_growi, 'upload_binary', fake_upload)
+    for p in ('notebook.ipynb', 'image.png'):
+        shutil.copy(str(DATA / p), str(tmp_path / p))
+    return tmp_path
+
+
+def _render(workdir, dest, *options):
+    args = vars(parser.parse_args(['up', str(workdir / 'notebook.ipynb'), '--no-output', *options]))
+    args.update(token='token', dest=dest, team='team', url='http://growi', upload_cache=None)
+    with IpynbProcessor(**args) as proc:
+        proc.preprocess()
+        return proc.path_md.read_bytes()
+
+
+def _publish(workdir, dest, *options, **kwargs):
+    '''preprocess, publish and save in destructive mode as `esa up` does, returns the processor
+    '''
+    args = vars(parser.parse_args(['up', str(workdir / 'notebook.ipynb'), *options]))
+    args.update(token='token', dest=dest, team='team', url='http://growi', upload_cache=None)
+    args.update(kwargs)
+    with IpynbProcessor(**args) as proc:
+        proc.preprocess()
+        proc.upload_body()
+        proc.save()
+    return proc
+
+
+@pytest.mark.parametrize('dest', ['esa', 'growi'])
+def test_golden(workdir, dest):
+    assert _render(workdir, dest) == (DATA / 'notebook_{:s}.md'.format(dest)).read_bytes()
+
+
+def test_render_cache(workdir):
+    cache = dict(cache_dir=str(workdir / 'cells'), max_entries=100)
+    args = vars(parser.parse_args(['up', str(workdir / 'notebook.ipynb'), '--no-output']))
+    args.update(token='token', dest='esa', team='team', upload_cache=None, render_cache=cache)
+    for _ in range(2):
+        with IpynbProcessor(**args) as proc:
+            proc.preprocess()
+            assert proc.path_md.read_bytes() == (DATA / 'notebook_esa.md').read_bytes()
+    assert proc.summary['cells_rebuilt'] == 0
+    assert proc.summary['cells_reused'] == len(proc.nbjson['cells'])
+
+
+@pytest.mark.parametrize('dest', ['esa', 'growi'])
+def test_golden_jobs(workdir, dest):
+    out = _render(workdir, dest, '--jobs', '2', '--parallel-threshold', '0')
+    assert out == (DATA / 'notebook_{:s}.md'.format(dest)).read_bytes()
+
+
+def test_publish_growi(workdir, monkeypatch):
+    calls = []
+
+    def fake_create(body_md, token=None, url=None, name=None, proxy=None):
+        calls.append(('create',))
+        page = {'_id': 'p1', 'path': '/user/me/notebook', 'revision': 'r1'}
+        return url + page['path'], FakeResponse(200, {'data': {'page': page, 'revision': {'_id': 'r1'}}})
+
+    def fake_patch(page_id, body_md, name, token=None, url=None, proxy=None, revision_id=None):
+        calls.append(('patch', page_id, revision_id))
+        page = {'_id': 'p1', 'path': '/user/me/notebook', 'revision': 'r2'}
+        return url + page['path'], FakeResponse(200, {'ok': True, 'page': page})
+
+    monkeypatch.setattr(api_growi, 'create_post', fake_create)
+    monkeypatch.setattr(api_growi, 'patch_post', fake_patch)
+
+    # response of v3 api is unwrapped from `data`
+    proc = _publish(workdir, 'growi')
+    post_info = proc.nbjson['metadata']['esapy']['post_info']
+    assert post_info['page']['_id'] == 'p1'
+    assert post_info['revision_id'] == 'r1'
+
+    # the revision of the previous publish is used at the next update
+    proc = _publish(workdir, 'growi', '--force-update')
+    assert calls == [('create',), ('patch', 'p1', 'r1')]
+    assert proc.nbjson['metadata']['esapy']['post_info']['revision_id'] == 'r2'
+
+
+@pytest.fixture
+def fake_esa(monkeypatch):
+    '''fake create/patch of esa.io posts, and a session answering 304 to lookups of the post
+    '''
+    calls = []
+
+    def post(name, category):
+        return dict(number=1, name=name or 'notebook', category=category or 'dev', tags=[], wip=True,
+                    url='https://team.esa.io/posts/1', created_at='2021-07-26T10:00:00+09:00',
+                    updated_at='2021-07-26T10:00:00+09:00')
+
+    def fake_create(body_md, name=None, category=None, **kwargs):
+        calls.append(('create', name))
+        return 'https://team.esa.io/posts/1', FakeResponse(200, post(name, category), {'ETag': 'W/"e1"'})
+
+    def fake_patch(post_number, body_md, name=None, category=None, **kwargs):
+        calls.append(('patch', name))
+        return 'https://team.esa.io/posts/1', FakeResponse(200, post(name, category), {'ETag': 'W/"e1"'})
+
+    def fake_request(method, url, headers=None, **kwargs):
+        calls.append((method, headers.get('If-None-Match')))
+        return FakeResponse(304, {}, {'ETag': 'W/"e1"'})
+
+    monkeypatch.setattr(api_esa, 'create_post', fake_create)
+    monkeypatch.setattr(api_esa, 'patch_post', fake_patch)
+    monkeypatch.setattr(api_esa.get_client('token', 'team', None).session, 'request', fake_request)
+    yield calls
+    api_esa._registry.close()
+
+
+def test_post_lookup(workdir, fake_esa):
+    _publish(workdir, 'esa', '--name', 'nb')
+    assert fake_esa == [('create', 'nb')]
+
+    # not modified: attributes recorded in metadata are used
+    proc = _publish(workdir, 'esa', '--force-update')
+    assert fake_esa[1:] == [('GET', 'W/"e1"'), ('patch', 'nb')]
+    assert proc.nbjson['metadata']['esapy']['post_info']['etag'] == 'W/"e1"'
+
+    # never: no request for lookup
+    _publish(workdir, 'esa', '--force-update', '--post-lookup', 'never')
+    assert fake_esa[3:] == [('patch', 'nb')]
+
+
+def test_reset_clears_upload_cache(workdir, uploads, fake_esa):
+    cache = dict(cache_dir=str(workdir / 'cache'))
+    proc = _publish(workdir, 'esa', upload_cache=cache)
+    n = len(uploads)
+    assert proc.summary['images_uploaded'] > 0
+
+    # urls are served from the upload cache, and counted as reused
+    reset_ipynb(str(workdir / 'notebook.ipynb'), clear_hashdict=True)
+    proc = _publish(workdir, 'esa', upload_cache=cache)
+    assert len(uploads) == n
+    assert proc.summary['images_uploaded'] == 0 and proc.summary['images_reused'] > 0
+
+    # --clear-hashdict with the upload cache: everything is uploaded again
+    reset_ipynb(str(workdir / 'notebook.ipynb'), clear_hashdict=True, upload_cache=cache)
+    proc = _publish(workdir, 'esa', upload_cache=cache)
+    assert len(uploads) == 2 * n
+    assert proc.summary['images_reused'] == 0
+
+
+def test_same_image_is_uploaded_once(workdir, uploads):
+    b64 = base64.b64encode((workdir / 'image.png').read_bytes()).decode()
+    nb = json.loads((DATA / 'notebook.ipynb').read_text(encoding='utf-8'))
+    nb['cells'] = [dict(cell_type='markdown', metadata={}, source=['![a](image.png) ![b](image.png)\n']),
+                   dict(cell_type='code', metadata={}, execution_count=1, source=['plot()'],
+                        outputs=[dict(output_type='display_data', metadata={}, data={'image/png': b64})])]
+    (workdir / 'notebook.ipynb').write_text(json.dumps(nb), encoding='utf-8')
+
+    args = vars(parser.parse_args(['up', str(workdir / 'notebook.ipynb'), '--upload-workers', '4']))
+    args.update(token='token', dest='esa', team='team', upload_cache=None)
+    summary = []
+    for _ in range(2):
+        with IpynbProcessor(**args) as proc:
+            proc.preprocess()
+            proc.save()
+        summary.append(proc.summary)
+    assert len(uploads) == 1
+
+    # counted by references in both runs
+    assert summary[0]['images_uploaded'] == 3 and summary[0]['images_reused'] == 0
+    assert summary[1]['images_uploaded'] == 0 and summary[1]['images_reused'] == 3
+
+
+def test_markdown_hashdict(workdir, uploads, fake_esa):
+    path_md = workdir / 'note.md'
+    path_md.write_text('# note\n'
+                       '![a](image.png) and ![m](missing.png)\n'
+                       '![r](https://example.org/r.png)\n', encoding='utf-8')
+    args = vars(parser.parse_args(['up', str(path_md)]))
+    args.update(token='token', dest='esa', team='team', upload_cache=None)
+
+    bodies = []
+    for _ in range(2):
+        with MarkdownProcessor(**args) as proc:
+            proc.preprocess()
+            bodies.append(proc.path_md.read_text(encoding='utf-8'))
+            proc.upload_body()
+            proc.save()
+
+    # urls are recorded in frontmatter, and not uploaded at the second run
+    assert uploads == ['image.png']
+    assert bodies[0] == bodies[1]
+    assert 'hashdict:' in path_md.read_text(encoding='utf-8')
+
+    # a missing file is left as written, and remote urls are untouched
+    assert bodies[0] == ('# note\n'
+                         '![a](https://example.com/1) and ![m](missing.png)\n'
+                         '![r](https://example.org/r.png)\n')
+
+
+def test_skip_unchanged_esa(workdir, fake_esa):
+    proc = _publish(workdir, 'esa')
+    proc = _publish(workdir, 'esa')
+    assert proc.summary['publish'] == 'skipped (unchanged)'
+    assert [c[0] for c in fake_esa] == ['create', 'GET']
+
+    proc = _publish(workdir, 'esa', '--force-update')
+    assert proc.summary['publish'] == 'updated'
+    assert [c[0] for c in fake_esa] == ['create', 'GET', 'GET', 'patch']
+
+
+def test_skip_unchanged_esa_always(workdir, monkeypatch, fake_esa):
+    proc = _publish(workdir, 'esa')
+    post = dict(proc.nbjson['metadata']['esapy']['post_info'], body_md='body', body_html='body')
+    monkeypatch.setattr(api_esa, 'get_post', lambda number, **kwargs: dict(post))
+
+    proc = _publish(workdir, 'esa', '--post-lookup', 'always')
+    assert proc.summary['publish'] == 'skipped (unchanged)'
+
+    # edited on esa.io
+    post['updated_at'] = '2021-07-27T10:00:00+09:00'
+    proc = _publish(workdir, 'esa', '--post-lookup', 'always')
+    assert proc.summary['publish'] == 'updated'
+    assert [c[0] for c in fake_esa] == ['create', 'patch']
+    assert 'body_md' not in proc.nbjson['metadata']['esapy']['post_info']
+
+
+def test_skip_unchanged_growi(workdir, monkeypatch):
+    calls = []
+    revision = ['r1']  # latest revision on the server
+
+    def fake_create(body_md, token=None, url=None, name=None, proxy=None):
+        calls.append('create')
+        page = {'_id': 'p1', 'path': '/user/me/notebook', 'revision': revision[0]}
+        return url + page['path'], FakeResponse(200, {'data': {'page': page, 'revision': {'_id': revision[0]}}})
+
+    def fake_patch(page_id, body_md, name, token=None, url=None, proxy=None, revision_id=None):
+        calls.append('patch')
+        revision[0] = 'r{:d}'.format(int(revision[0][1:]) + 1)
+        page = {'_id': 'p1', 'path': '/user/me/notebook', 'revision': revision[0]}
+        return url + page['path'], FakeResponse(200, {'ok': True, 'page': page})
+
+    def fake_get(page_id, token=None, url=None, proxy=None):
+        calls.append('get')
+        return {'_id': page_id, 'path': '/user/me/notebook', 'revision': {'_id': revision[0]}}
+
+    monkeypatch.setattr(api_growi, 'create_post', fake_create)
+    monkeypatch.setattr(api_growi, 'patch_post', fake_patch)
+    monkeypatch.setattr(api_growi, 'get_post', fake_get)
+
+    _publish(workdir, 'growi')
+    proc = _publish(workdir, 'growi')
+    assert proc.summary['publish'] == 'skipped (unchanged)'
+    assert calls == ['create', 'get']
+
+    # edited on the server
+    revision[0] = 'r5'
+    proc = _publish(workdir, 'growi')
+    assert proc.summary['publish'] == 'updated'
+    assert calls == ['create', 'get', 'get', 'patch']
+
+
+def test_journal_is_cleared(workdir, fake_esa):
+    path_nb = workdir / 'notebook.ipynb'
+    journal = UploadJournal(path_nb)
+
+    journal.append('esa', 'team', 'h1', 'https://example.com/stale')
+    reset_ipynb(str(path_nb), clear_hashdict=True)
+    assert journal.replay('esa', 'team') == {}
+
+    # hashdict is written to --output
+    journal.append('esa', 'team', 'h1', 'https://example.com/stale')
+    _publish(workdir, 'esa', '--output', str(workdir / 'out.ipynb'))
+    assert journal.replay('esa', 'team') == {}
+
+
+def test_dead_urls_are_uploaded_again(workdir, monkeypatch, uploads, fake_esa):
+    cache = dict(cache_dir=str(workdir / 'cache'))
+    proc = _publish(workdir, 'esa', upload_cache=cache)
+    hashdict = dict(proc.nbjson['metadata']['esapy']['hashdict'])
+    assert len(hashdict) >= 2
+    h_dead, url_dead = sorted(hashdict.items())[0]
+    checked = []
+
+    def fake_is_alive(url, **kwargs):
+        checked.append(url)
+        return url != url_dead
+
+    monkeypatch.setattr(api_esa, 'is_alive', fake_is_alive)
+    n = len(uploads)
+    proc = _publish(workdir, 'esa', '--validate-urls', upload_cache=cache)
+    assert sorted(checked) == sorted(hashdict.values())
+
+    # only the dead one is uploaded again, and replaced in hashdict and the upload cache
+    assert len(uploads) == n + 1
+    hashdict_new = proc.nbjson['metadata']['esapy']['hashdict']
+    assert hashdict_new[h_dead] == 'https://example.com/{:d}'.format(n + 1)
+    assert {h: u for h, u in hashdict_new.items() if h != h_dead} == \
+        {h: u for h, u in hashdict.items() if h != h_dead}
+    with UploadCache(**cache) as c:
+        assert c.get('esa', 'team', h_dead) == hashdict_new[h_dead]
+        assert not any(c.needs_check(u) for h, u in hashdict.items() if h != h_dead)
+        assert c.needs_check(url_dead)
+
+
+def test_post_lookup_errors(workdir, monkeypatch, fake_esa):
+    _publish(workdir, 'esa', '--name', 'nb')
+    session = api_esa.get_client('token', 'team', None).session
+    monkeypatch.setitem(httpclient.config, 'max_retries', 0)
+
+    # the post may exist: nothing is published
+    def fake_request(method, url, **kwargs):
+        raise requests.ConnectionError('down')
+
+    monkeypatch.setattr(session, 'request', fake_request)
+    with pytest.raises(httpclient.NetworkError):
+        _publish(workdir, 'esa', '--force-update')
+    assert fake_esa == [('create', 'nb')]
+
+    # the post has been removed: a new post is created
+    monkeypatch.setattr(session, 'request', lambda method, url, **kwargs: FakeResponse(404, {}))
+    _publish(workdir, 'esa', '--force-update')
+    assert fake_esa == [('create', 'nb'), ('create', 'nb')]
+
+
+def test_markdown_empty_frontmatter(workdir):
+    path_md = workdir / 'note.md'
+    path_md.write_text('---\n---\n# note\n![a](image.png)\n', encoding='utf-8')
+    args = vars(parser.parse_args(['up', str(path_md), '--no-output']))
+    args.update(token='token', dest='esa', team='team', upload_cache=None)
+    with MarkdownProcessor(**args) as proc:
+        assert proc.preprocess()
+        assert proc.get_post_number() is None
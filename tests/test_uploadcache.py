@@ -0,0 +1,79 @@
+import threading
+import time
+
+from esapy.uploadcache import UploadCache, UploadJournal
+
+
+def test_put_get_invalidate(tmp_path):
+    with UploadCache(cache_dir=tmp_path) as c:
+        assert c.get('esa', 'team', 'abc') is None
+        c.put('esa', 'team', 'abc', 'https://example.com/a.png', size=3)
+        assert c.get('esa', 'team', 'abc') == 'https://example.com/a.png'
+        assert c.get('esa', 'other', 'abc') is None
+        assert c.get('growi', 'team', 'abc') is None
+        c.invalidate('esa', 'team', 'abc')
+        assert c.get('esa', 'team', 'abc') is None
+
+    # persistent across instances
+    with UploadCache(cache_dir=tmp_path) as c:
+        c.put('esa', 'team', 'x', 'u')
+    with UploadCache(cache_dir=tmp_path) as c:
+        assert c.get('esa', 'team', 'x') == 'u'
+
+
+def test_evict_by_count_and_age(tmp_path):
+    with UploadCache(cache_dir=tmp_path, max_entries=2, max_age=1) as c:
+        for i in range(3):
+            c.put('esa', 'team', str(i), 'u%d' % i)
+            time.sleep(0.01)
+        assert c.evict() == 1
+        assert c.get('esa', 'team', '0') is None
+        assert c.get('esa', 'team', '2') == 'u2'
+
+        c._conn.execute('UPDATE uploads SET used_at=0')
+        assert c.evict() == 2
+
+
+def test_concurrent_access(tmp_path):
+    caches = [UploadCache(cache_dir=tmp_path) for _ in range(4)]
+
+    def work(c, k):
+        for i in range(50):
+            c.put('esa', 'team', '%d-%d' % (k, i), 'u')
+            assert c.get('esa', 'team', '%d-%d' % (k, i)) == 'u'
+
+    threads = [threading.Thread(target=work, args=(c, k)) for k, c in enumerate(caches)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for c in caches:
+        c.close()
+
+    with UploadCache(cache_dir=tmp_path) as c:
+        assert c._conn.execute('SELECT COUNT(*) FROM uploads').fetchone()[0] == 200
+
+
+def test_journal_replay(tmp_path):
+    j = UploadJournal(tmp_path / 'nb.ipynb', cache_dir=tmp_path)
+    j.append('esa', 'team', 'h1', 'u1')
+    j.append('growi', 'http://g', 'h2', 'u2')
+    j.close()
+    with j.path.open('a', encoding='utf-8') as f:
+        f.write('{"dest": "esa", "ba')  # killed while writing
+
+    j = UploadJournal(tmp_path / 'nb.ipynb', cache_dir=tmp_path)
+    assert j.replay('esa', 'team') == {'h1': 'u1'}
+    j.append('esa', 'team', 'h3', 'u3')
+    assert j.replay('esa', 'team') == {'h1': 'u1', 'h3': 'u3'}
+    assert UploadJournal(tmp_path / 'other.ipynb', cache_dir=tmp_path).replay('esa', 'team') == {}
+    j.clear()
+    assert j.replay('esa', 'team') == {}
+
+
+def test_journal_disabled(tmp_path):
+    j = UploadJournal(None, cache_dir=tmp_path)
+    j.append('esa', 'team', 'h1', 'u1')
+    assert j.replay('esa', 'team') == {}
+    j.clear()
+    assert not (tmp_path / 'journal').exists()